@@ -1,6 +1,6 @@
 {
     "name": "Product Import CWA",
-    "version": "16.0.1.0.0",
+    "version": "16.0.1.1.0",
     "author": "Sunflower IT, Gedeelde Weelde",
     "license": "AGPL-3",
     "category": "Sales",
@@ -13,10 +13,12 @@
         "product_brand",
         "uom",
         "product_food_fields",
+        "queue_job",
     ],
     "data": [
         "data/res_partner.xml",
         "data/ir_cron.xml",
+        "data/queue_job.xml",
         "data/pos_categories.xml",
         "data/product_food_fields_product_quality.xml",
         "data/cwa_product_quality.xml",
@@ -27,6 +29,9 @@
         "views/product_supplierinfo.xml",
         "views/cwa_import_action.xml",
         "views/cwa_import_product_change.xml",
+        "views/cwa_import_error.xml",
+        "views/cwa_import_run.xml",
+        "views/cwa_import_run_phase.xml",
         "views/cwa_product_brands.xml",
         "views/cwa_product_cblcode.xml",
         "views/cwa_product_quality.xml",
@@ -41,6 +46,7 @@
         "wizard/cwa_locate_cblcode_wizard.xml",
         "wizard/cwa_locate_uom_wizard.xml",
         "wizard/cwa_vat_tax_wizard.xml",
+        "wizard/cwa_import_feed_wizard.xml",
         "security/ir.model.access.csv",
         "views/res_config_settings.xml",
     ],
@@ -6,6 +6,10 @@ from . import cwa_product_quality
 from . import cwa_product_suppliers
 from . import cwa_product_uom
 from . import cwa_import_product_change
+from . import cwa_import_error
+from . import cwa_import_run
+from . import cwa_import_run_chunk
+from . import cwa_import_run_phase
 from . import product_supplierinfo
 from . import product_template
 from . import cwa_vat_tax
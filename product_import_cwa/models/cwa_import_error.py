@@ -0,0 +1,24 @@
+from odoo import api, fields, models
+
+
+class CwaImportError(models.Model):
+    _name = "cwa.import.error"
+    _description = "CWA Import Error"
+    _order = "create_date desc, id desc"
+    _rec_name = "unique_id"
+
+    unique_id = fields.Char(index=True)
+    res_model = fields.Char("Model")
+    message = fields.Text()
+    values = fields.Json(help="The row that could not be loaded.")
+
+    @api.model
+    def log_error(self, unique_id, message, res_model, values=None):
+        return self.create(
+            {
+                "unique_id": unique_id,
+                "message": message,
+                "res_model": res_model,
+                "values": values,
+            }
+        )
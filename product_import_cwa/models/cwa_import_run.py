@@ -0,0 +1,353 @@
+import datetime
+import hashlib
+import logging
+import os
+import zlib
+
+import psycopg2
+from psycopg2 import errors
+
+from odoo import api, fields, models
+from odoo.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
+
+from odoo.addons.queue_job.delay import chain
+from odoo.addons.queue_job.exception import RetryableJobError
+
+from .utils import PhaseRecorder, XMLProductLoader, split_data
+
+READ_BLOCK_SIZE = 1024 * 1024
+# Number of records handled by one job of an import pipeline
+PIPELINE_CHUNK_SIZE = 1000
+# Key of the PostgreSQL advisory lock held by the transaction importing a feed
+IMPORT_LOCK_KEY = zlib.crc32(b"product_import_cwa.import")
+# Seconds before a job that found the import lock taken is run again
+LOCKED_JOB_RETRY_DELAY = 60
+# A running pipeline none of whose jobs wrote to it for this long is dead
+PIPELINE_STALE_AFTER = datetime.timedelta(hours=6)
+# Errors on which queue_job runs a job again, instead of failing its pipeline
+RETRYABLE_JOB_ERRORS = (
+    RetryableJobError,
+    *(errors.lookup(code) for code in PG_CONCURRENCY_ERRORS_TO_RETRY),
+)
+
+_logger = logging.getLogger(__name__)
+
+
+class CwaImportRun(models.Model):
+    _name = "cwa.import.run"
+    _description = "CWA Import Run"
+    _order = "start_date desc, id desc"
+
+    name = fields.Char("Feed file", required=True)
+    state = fields.Selection(
+        [
+            ("running", "Running"),
+            ("done", "Done"),
+            ("skipped", "Skipped"),
+            ("failed", "Failed"),
+        ],
+        default="running",
+        required=True,
+    )
+    start_date = fields.Datetime(default=fields.Datetime.now, required=True)
+    end_date = fields.Datetime()
+    file_sha256 = fields.Char("SHA-256", index=True)
+    file_size = fields.Integer("Size (bytes)")
+    remote_mtime = fields.Datetime(
+        "Modified on", help="Modification time of the feed on the FTP server."
+    )
+    forced = fields.Boolean(help="The import ran even though the feed was unchanged.")
+    records_count = fields.Integer("Records processed")
+    lock_holder = fields.Char(
+        readonly=True,
+        help="User and database backend that held the import lock for this run.",
+    )
+    pipeline = fields.Boolean(
+        readonly=True, help="The feed is imported by a pipeline of jobs."
+    )
+    feed_path = fields.Char(readonly=True)
+    load_keys = fields.Json(readonly=True)
+    chunk_ids = fields.One2many("cwa.import.run.chunk", "run_id", "Chunks")
+    phase_ids = fields.One2many("cwa.import.run.phase", "run_id", "Phases")
+    chunks_count = fields.Integer(compute="_compute_progress")
+    chunks_done = fields.Integer(compute="_compute_progress")
+    progress = fields.Float(compute="_compute_progress")
+    unknown_tags = fields.Json(
+        help="Tags in the feed that are not imported, with the number of "
+        "products they appeared in. New feed columns show up here."
+    )
+    error = fields.Text(readonly=True, help="Why the import pipeline failed.")
+
+    @api.depends("state", "chunk_ids.state")
+    def _compute_progress(self):
+        for run in self:
+            run.chunks_count = len(run.chunk_ids)
+            run.chunks_done = len(
+                run.chunk_ids.filtered(lambda chunk: chunk.state == "done")
+            )
+            if run.state == "done":
+                run.progress = 100.0
+            elif run.chunks_count:
+                run.progress = 100.0 * run.chunks_done / run.chunks_count
+            else:
+                run.progress = 0.0
+
+    @api.model
+    def get_file_fingerprint(self, prod_file, remote_mtime=None):
+        """Return the SHA-256, size and modification time of a feed file"""
+        sha256 = hashlib.sha256()
+        with open(prod_file, "rb") as file:
+            for block in iter(lambda: file.read(READ_BLOCK_SIZE), b""):
+                sha256.update(block)
+        if not remote_mtime:
+            remote_mtime = datetime.datetime.utcfromtimestamp(
+                os.path.getmtime(prod_file)
+            )
+        return {
+            "name": os.path.basename(prod_file),
+            "file_sha256": sha256.hexdigest(),
+            "file_size": os.path.getsize(prod_file),
+            "remote_mtime": remote_mtime,
+        }
+
+    @api.model
+    def is_feed_unchanged(self, fingerprint):
+        """A feed is unchanged when it equals the last successfully imported one"""
+        last_run = self.search([("state", "=", "done")], limit=1)
+        return bool(
+            last_run
+            and last_run.file_sha256 == fingerprint["file_sha256"]
+            and last_run.file_size == fingerprint["file_size"]
+        )
+
+    @api.model
+    def is_remote_feed_unchanged(self, name, size, remote_mtime):
+        """
+        Tell a remote feed unchanged by its name, size and modification time,
+        before it is downloaded
+        """
+        last_run = self.search([("state", "=", "done")], limit=1)
+        return bool(
+            last_run
+            and last_run.name == name
+            and last_run.file_size == size
+            and last_run.remote_mtime == remote_mtime
+        )
+
+    @api.model
+    def _get_import_lock_wait(self):
+        return int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cwa_import_lock_wait", default=0)
+        )
+
+    def acquire_import_lock(self):
+        """
+        Take the lock that keeps CWA imports from overlapping, until the end
+        of the transaction. The lock is unavailable while another transaction
+        imports a feed, or while a job pipeline other than this run is still
+        running. Depending on 'cwa_import_lock_wait', give up at once or wait
+        that many seconds for it. Return whether the lock was taken.
+        """
+        cr = self.env.cr
+        wait = self._get_import_lock_wait()
+        if wait > 0:
+            cr.execute("SHOW lock_timeout")
+            lock_timeout = cr.fetchone()[0]
+            try:
+                with cr.savepoint(flush=False):
+                    cr.execute(
+                        "SELECT set_config('lock_timeout', %s, true)", (f"{wait}s",)
+                    )
+                    cr.execute("SELECT pg_advisory_xact_lock(%s)", (IMPORT_LOCK_KEY,))
+                locked = True
+            except psycopg2.errors.LockNotAvailable:
+                locked = False
+            cr.execute("SELECT set_config('lock_timeout', %s, true)", (lock_timeout,))
+        else:
+            cr.execute("SELECT pg_try_advisory_xact_lock(%s)", (IMPORT_LOCK_KEY,))
+            locked = cr.fetchone()[0]
+        if not locked:
+            _logger.warning(
+                "Another CWA import is running in database backend %s",
+                ", ".join(map(str, self._get_import_lock_backends())) or "?",
+            )
+            return False
+        # checked once locked, so a pipeline started meanwhile is committed
+        pipelines = self.search(
+            [
+                ("pipeline", "=", True),
+                ("state", "=", "running"),
+                ("id", "not in", self.ids),
+            ]
+        )
+        stale = pipelines.filtered(
+            lambda run: run.write_date < fields.Datetime.now() - PIPELINE_STALE_AFTER
+        )
+        for run in stale:
+            _logger.warning("CWA import pipeline %s stopped running", run.name)
+            run.mark_failed(f"No job of the pipeline ran for {PIPELINE_STALE_AFTER}")
+        pipeline = (pipelines - stale)[:1]
+        if pipeline:
+            _logger.warning(
+                "CWA import pipeline %s started by %s is still running",
+                pipeline.name,
+                pipeline.lock_holder,
+            )
+            return False
+        return True
+
+    @api.model
+    def _get_import_lock_backends(self):
+        self.env.cr.execute(
+            """
+            SELECT pid FROM pg_locks
+            WHERE locktype = 'advisory' AND classid = 0 AND objid = %s::oid
+                AND objsubid = 1 AND granted
+            """,
+            (IMPORT_LOCK_KEY,),
+        )
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    @api.model
+    def get_lock_holder(self):
+        self.env.cr.execute("SELECT pg_backend_pid()")
+        return f"{self.env.user.name} (database backend {self.env.cr.fetchone()[0]})"
+
+    def _acquire_job_import_lock(self):
+        """Take the import lock for a job of this run, or have it run later"""
+        self.ensure_one()
+        if not self.acquire_import_lock():
+            raise RetryableJobError(
+                "Another CWA import is running",
+                seconds=LOCKED_JOB_RETRY_DELAY,
+                ignore_retry=True,
+            )
+        self.lock_holder = self.get_lock_holder()
+
+    def record_phases(self, phases):
+        """Store the phases measured by a PhaseRecorder on this run"""
+        self.ensure_one()
+        self.env["cwa.import.run.phase"].create(
+            [dict(phase, run_id=self.id) for phase in phases.phases]
+        )
+
+    def _job_prepare_context_before_enqueue_keys(self):
+        # the jobs load new products the way the import was asked to
+        return super()._job_prepare_context_before_enqueue_keys() + ("cwa_orm_load",)
+
+    def mark_done(self, records_count):
+        self.write(
+            {
+                "state": "done",
+                "end_date": fields.Datetime.now(),
+                "records_count": records_count,
+            }
+        )
+
+    def mark_failed(self, error):
+        self.write(
+            {"state": "failed", "end_date": fields.Datetime.now(), "error": str(error)}
+        )
+
+    def run_job_step(self, step, *args):
+        """
+        Run a step of a pipeline job. A step that fails is rolled back and
+        marks the run failed, instead of leaving it running: that would hold
+        off every later import. The failed run can be resumed. Concurrency
+        errors are raised again, for queue_job to retry the job.
+        """
+        self.ensure_one()
+        try:
+            with self.env.cr.savepoint():
+                return step(*args)
+        except RETRYABLE_JOB_ERRORS:
+            raise
+        except Exception as error:
+            _logger.exception("CWA import pipeline %s failed", self.name)
+            self.mark_failed(error)
+
+    def job_parse_feed(self):
+        """Parse the feed and split the outcome into chunks, then queue them"""
+        self.ensure_one()
+        self._acquire_job_import_lock()
+        if self.chunk_ids:
+            # parsed before, the chunks are the checkpoint
+            self._enqueue_chunks()
+            return
+        self.run_job_step(self._parse_feed_into_chunks)
+
+    def _parse_feed_into_chunks(self):
+        product_model = self.env["cwa.product"]
+        loader = XMLProductLoader(product_model)
+        loader.phases = PhaseRecorder(self.env.cr)
+        with loader.phases.measure("parse") as phase:
+            keys, to_load, to_update, to_delete = product_model._parse_feed(
+                loader, self.feed_path
+            )
+            phase["rows"] = len(loader.new_unique_ids)
+        self.record_phases(loader.phases)
+        chunks = []
+        for kind, records in (
+            ("load", to_load),
+            ("update", to_update),
+            ("delete", to_delete),
+        ):
+            for payload in split_data(list(records), PIPELINE_CHUNK_SIZE):
+                chunks.append(
+                    {
+                        "run_id": self.id,
+                        "sequence": len(chunks),
+                        "kind": kind,
+                        "payload": payload,
+                        "size": len(payload),
+                    }
+                )
+        self.env["cwa.import.run.chunk"].create(chunks)
+        self.write(
+            {"load_keys": keys, "unknown_tags": dict(loader.unknown_tags) or False}
+        )
+        self._enqueue_chunks()
+
+    def _enqueue_chunks(self):
+        self.ensure_one()
+        jobs = [
+            chunk.delayable(
+                description=f"CWA feed {self.name}: {chunk.kind} chunk {chunk.sequence}"
+            ).run_chunk()
+            for chunk in self.chunk_ids
+            if chunk.state == "pending"
+        ]
+        finish = self.delayable(
+            description=f"CWA feed {self.name}: compare prices"
+        ).job_finish()
+        # one after the other: the chunks all need the import lock
+        chain(*jobs, finish).delay()
+
+    def job_finish(self):
+        self.ensure_one()
+        if self.state != "running":
+            return
+        self._acquire_job_import_lock()
+        self.run_job_step(self._finish)
+
+    def _finish(self):
+        phases = PhaseRecorder(self.env.cr)
+        with phases.measure("compare_prices") as phase:
+            phase["rows"] = self.env["cwa.product"]._compare_supplier_prices(
+                [
+                    unique_id
+                    for chunk in self.chunk_ids
+                    for unique_id in chunk.unique_ids or []
+                ]
+            )
+        self.record_phases(phases)
+        self.mark_done(sum(self.chunk_ids.mapped("records_count")))
+
+    def action_resume(self):
+        """Queue again whatever a stopped import pipeline did not finish"""
+        for run in self.filtered(lambda run: run.pipeline and run.state != "done"):
+            run.write({"state": "running", "end_date": False, "error": False})
+            run.with_delay(description=f"Parse CWA feed {run.name}").job_parse_feed()
+        return True
@@ -0,0 +1,72 @@
+from odoo import fields, models
+
+from .utils import PhaseRecorder
+
+
+class CwaImportRunChunk(models.Model):
+    _name = "cwa.import.run.chunk"
+    _description = "CWA Import Run Chunk"
+    _order = "run_id, sequence"
+
+    run_id = fields.Many2one(
+        "cwa.import.run", "Import run", required=True, ondelete="cascade", index=True
+    )
+    sequence = fields.Integer()
+    kind = fields.Selection(
+        [("load", "Load"), ("update", "Update"), ("delete", "Delete")],
+        required=True,
+    )
+    state = fields.Selection(
+        [("pending", "Pending"), ("done", "Done")], default="pending", required=True
+    )
+    size = fields.Integer("Records")
+    records_count = fields.Integer("Records processed")
+    payload = fields.Json(
+        help="Rows to load, values to update or unique ids to delete."
+    )
+    unique_ids = fields.Json(
+        help="Unique ids of the loaded or updated products, of which the "
+        "prices are compared when the run finishes."
+    )
+
+    def _job_prepare_context_before_enqueue_keys(self):
+        return super()._job_prepare_context_before_enqueue_keys() + ("cwa_orm_load",)
+
+    def run_chunk(self):
+        self.ensure_one()
+        # the chunks after a failed one wait for the run to be resumed
+        if self.state == "done" or self.run_id.state != "running":
+            return
+        self.run_id._acquire_job_import_lock()
+        self.run_id.run_job_step(self._apply)
+
+    def _apply(self):
+        product_model = self.env["cwa.product"]
+        phases = PhaseRecorder(self.env.cr)
+        with phases.measure(self.kind) as phase:
+            if self.kind == "load":
+                count = product_model._load_new_records(
+                    self.run_id.load_keys, self.payload
+                )
+            elif self.kind == "update":
+                count = product_model.update_records(self.payload, "cwa.product")
+            else:
+                count = product_model.delete_records(self.payload, "cwa.product")
+            phase["rows"] = count
+        self.run_id.record_phases(phases)
+        if self.kind == "load":
+            unique_id_index = self.run_id.load_keys.index("unique_id")
+            unique_ids = [values[unique_id_index] for values in self.payload]
+        elif self.kind == "update":
+            unique_ids = [values["unique_id"] for values in self.payload]
+        else:
+            unique_ids = False
+        # the payload is not needed anymore once the chunk is done
+        self.write(
+            {
+                "state": "done",
+                "records_count": count,
+                "payload": False,
+                "unique_ids": unique_ids,
+            }
+        )
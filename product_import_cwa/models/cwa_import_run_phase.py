@@ -0,0 +1,32 @@
+from odoo import fields, models
+
+PHASE_SELECTION = [
+    ("fetch", "FTP fetch"),
+    ("hash_load", "Existing hashes"),
+    ("parse", "Parse"),
+    ("load", "Load"),
+    ("update", "Update"),
+    ("delete", "Delete"),
+    ("compare_prices", "Compare prices"),
+]
+
+
+class CwaImportRunPhase(models.Model):
+    _name = "cwa.import.run.phase"
+    _description = "CWA Import Run Phase"
+    _order = "start_date desc, id"
+
+    run_id = fields.Many2one(
+        "cwa.import.run", "Import run", required=True, ondelete="cascade", index=True
+    )
+    start_date = fields.Datetime(related="run_id.start_date", store=True)
+    name = fields.Selection(PHASE_SELECTION, "Phase", required=True)
+    duration = fields.Float("Duration (s)", digits=(16, 3), group_operator="sum")
+    query_count = fields.Integer("Queries", group_operator="sum")
+    rows = fields.Integer("Rows", group_operator="sum")
+    peak_rss = fields.Float(
+        "Peak RSS (MB)",
+        digits=(16, 1),
+        group_operator="max",
+        help="Peak memory use of the process that ran the phase, during the phase.",
+    )
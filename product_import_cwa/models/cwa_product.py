@@ -1,15 +1,45 @@
+import datetime
+import fcntl
 import ftplib
+import hashlib
+import io
+import json
 import logging
 import os
+import tempfile
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+
+import psycopg2
+from psycopg2 import sql
 
 from odoo import _, api, fields, models, tools
 from odoo.exceptions import ValidationError
 
-from .utils import PRESENCE_SELECTION, YESNO_SELECTION, XMLProductLoader, split_data
+from .feed_readers import XMLFeedReader, get_feed_reader, get_feed_reader_by_name
+from .feed_snapshot import get_snapshot_path, read_snapshot, write_snapshot
+from .utils import (
+    HASH_FETCH_SIZE,
+    HASHED_FIELDS,
+    PRESENCE_SELECTION,
+    RECORD_KEYS,
+    YESNO_SELECTION,
+    PhaseRecorder,
+    XMLProductLoader,
+    copy_text_value,
+    parse_ftp_timestamp,
+)
 
 _logger = logging.getLogger(__name__)
 
 CHUNKSIZE = 50
+MAX_CHUNKSIZE = 800
+# Number of downloaded feeds to keep in the local cache
+FEED_CACHE_SIZE = 5
+FTP_ROOT = "VoorWinkel"
+# Number of largest price changes listed by a dry run
+DRY_RUN_PRICE_MOVERS = 10
+PRICE_FIELDS = ("inkoopprijs", "consumentenprijs")
 
 # Fields to transfer to supplier info
 FIELDS_TO_SUPPLIER_INFO = (
@@ -88,6 +118,7 @@ FIELDS_TO_SUPPLIER_INFO = (
 FIELDS_TO_LOAD = FIELDS_TO_SUPPLIER_INFO + (
     (None, "unique_id"),
     (None, "hash"),
+    (None, "field_hashes"),
 )
 
 KEY_MAPPINGS_CWA_TO_PRODUCT = {
@@ -116,6 +147,11 @@ class CwaProduct(models.Model):
         default="new",
     )
     name = fields.Char("Product name", related="omschrijving")
+    active = fields.Boolean(
+        default=True,
+        help="Products that are no longer in the CWA feed are archived "
+        "when 'Archive removed products' is enabled.",
+    )
     vendor_id = fields.Many2one(
         "res.partner",
         "Leverancier",
@@ -198,29 +234,61 @@ class CwaProduct(models.Model):
         "NOT A REFERENCE", help="Not a reference field, just a char field."
     )
     hash = fields.Char(required=True)
+    field_hashes = fields.Char(
+        help="Digest per loaded field, used to write only the changed columns."
+    )
 
     def write(self, vals):
         result = super().write(vals)
+        if not set(vals).intersection(FIELDS_TO_SUPPLIER_INFO):
+            return result
         # TODO: This triggers very weird behaviour. Please fix after testing
         # (GED-24)
-        for cwa_product in self:
-            keys_write_now = set(vals.keys())
-            if not keys_write_now.intersection(FIELDS_TO_SUPPLIER_INFO):
-                continue
+        self._propagate_to_supplier_info()
+        return result
 
-            ## Find if this product has been transferred to a supplier info model
-            supplier_info = self.env["product.supplierinfo"].search(
-                [("unique_id", "=", cwa_product.unique_id)]
+    def _propagate_to_supplier_info(self):
+        """
+        Copy the supplier info fields of these products to the supplier infos
+        they were transferred to, and record the changes. The supplier infos
+        are found with one search and the products read at once. Only the
+        values that differ from those of the supplier info are written, so
+        supplier infos receiving the same changes are written together.
+        """
+        ## Find which products have been transferred to a supplier info model
+        supplier_infos = {}
+        for supplier_info in self.env["product.supplierinfo"].search(
+            [("unique_id", "in", self.filtered("unique_id").mapped("unique_id"))]
+        ):
+            supplier_infos[supplier_info.unique_id] = (
+                supplier_infos.get(supplier_info.unique_id, supplier_info.browse())
+                | supplier_info
             )
-            if supplier_info:
-                supplier_info_vals = {
-                    map_key(key): getattr(self, key) for key in FIELDS_TO_SUPPLIER_INFO
-                }
-                self._detect_product_changes(
-                    cwa_product, supplier_info, supplier_info_vals
+        cwa_products = self.filtered(
+            lambda product: product.unique_id in supplier_infos
+        )
+        if not cwa_products:
+            return
+        supplier_info_vals = {
+            values["id"]: {map_key(key): values[key] for key in FIELDS_TO_SUPPLIER_INFO}
+            for values in cwa_products.read(list(FIELDS_TO_SUPPLIER_INFO))
+        }
+        self._detect_product_changes(cwa_products, supplier_infos, supplier_info_vals)
+
+        supplier_infos_by_vals = defaultdict(self.env["product.supplierinfo"].browse)
+        for cwa_product in cwa_products:
+            vals = supplier_info_vals[cwa_product.id]
+            for supplier_info in supplier_infos[cwa_product.unique_id]:
+                changed_vals = tuple(
+                    (key, value)
+                    for key, value in vals.items()
+                    if supplier_info[key]
+                    != self._to_supplier_info_value(supplier_info, key, value)
                 )
-                supplier_info.write(supplier_info_vals)
-        return result
+                if changed_vals:
+                    supplier_infos_by_vals[changed_vals] |= supplier_info
+        for vals, supplier_info in supplier_infos_by_vals.items():
+            supplier_info.write(dict(vals))
 
     @api.model
     def parse_from_xml(self, prod_file):
@@ -232,27 +300,170 @@ class CwaProduct(models.Model):
 
     @api.model
     def update_records(self, records, model):
+        """
+        Apply changed records in bulk. The unique_ids are resolved with a
+        single query, records carrying identical values are written together
+        through the ORM (which propagates the changes to the supplier info)
+        and the per-record hashes are set with one UPDATE statement.
+        """
+        records_model = self.env[model]
+        ids_by_unique_id = self._get_ids_by_unique_id(
+            records_model, [record["unique_id"] for record in records]
+        )
+        ids_by_values = defaultdict(list)
+        hashes = {}
         count = 0
         for record in records:
-            rec = self.env[model].search([("unique_id", "=", record["unique_id"])])
-            if rec:
-                rec.write(record)
-                count += 1
-        return count
-
-    def _detect_product_changes(self, cwa_product, supplier_info, supplier_info_vals):
-        if cwa_product.eancode:
-            product_tmpl = self.env["product.template"].search(
-                [("eancode", "=", cwa_product.eancode)]
+            record_ids = ids_by_unique_id.get(record["unique_id"])
+            if not record_ids:
+                continue
+            count += 1
+            values = tuple(
+                sorted(
+                    (key, value)
+                    for key, value in record.items()
+                    if key not in RECORD_KEYS
+                )
             )
-        else:
-            product_tmpl = self.env["product.template"].search(
-                [("unique_id", "=", cwa_product.unique_id)]
+            ids_by_values[values].extend(record_ids)
+            hashes.update(
+                dict.fromkeys(record_ids, (record["hash"], record.get("field_hashes")))
             )
 
-        if product_tmpl:
-            changes = self._get_value_changes(supplier_info_vals, supplier_info)
-            cwa_import_product_change_model = self.env["cwa.import.product.change"]
+        for values, record_ids in ids_by_values.items():
+            if values:
+                records_model.browse(record_ids).write(dict(values))
+        self._write_hashes(records_model, hashes)
+        return count
+
+    @api.model
+    def _get_ids_by_unique_id(self, records_model, unique_ids):
+        ids_by_unique_id = defaultdict(list)
+        if not unique_ids:
+            return ids_by_unique_id
+        for record in records_model.with_context(active_test=False).search_read(
+            [("unique_id", "in", unique_ids)], ["unique_id"], order="id"
+        ):
+            ids_by_unique_id[record["unique_id"]].append(record["id"])
+        return ids_by_unique_id
+
+    @api.model
+    def _backfill_field_hashes(self):
+        """
+        Give the products imported before the per-field digests existed their
+        digest vector, built from the stored values written as the feed has
+        them. Without it their first change rewrites every column. A field
+        whose stored value is written differently in the feed (e.g. 0.1 and
+        0.10) is only reported changed once more.
+        """
+        self.flush_model()
+        cr = self.env.cr
+        loader = XMLProductLoader(self)
+        query = sql.SQL(
+            "SELECT id, hash, {} FROM cwa_product WHERE field_hashes IS NULL "
+            "ORDER BY id LIMIT %s"
+        ).format(sql.SQL(", ").join(map(sql.Identifier, HASHED_FIELDS)))
+        count = 0
+        while True:
+            cr.execute(query, (HASH_FETCH_SIZE,))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            hashes = {}
+            for record_id, record_hash, *values in rows:
+                load_dict = {
+                    name: self._get_feed_text(name, value)
+                    for name, value in zip(HASHED_FIELDS, values, strict=True)
+                }
+                hashes[record_id] = (record_hash, loader.create_field_hashes(load_dict))
+            self._write_hashes(self, hashes)
+            count += len(rows)
+        _logger.info("Backfilled the field digests of %s CWA products", count)
+        return count
+
+    @api.model
+    def _get_feed_text(self, name, value):
+        """Write a stored value of a field like the converted feed has it"""
+        if value is None:
+            return None
+        if name in PRICE_FIELDS:
+            return f"{value:.2f}"
+        field_type = self._fields[name].type
+        if field_type == "boolean":
+            return "true" if value else "false"
+        if field_type == "date":
+            return fields.Date.to_string(value)
+        return str(value)
+
+    @api.model
+    def _write_hashes(self, records_model, hashes):
+        if not hashes:
+            return
+        records_model.flush_model(["hash", "field_hashes"])
+        record_hashes, record_field_hashes = zip(*hashes.values(), strict=True)
+        self.env.cr.execute(
+            sql.SQL(
+                """
+                UPDATE {table}
+                SET hash = new.hash,
+                    field_hashes = COALESCE(new.field_hashes, {table}.field_hashes)
+                FROM unnest(%s::int[], %s::varchar[], %s::varchar[])
+                    AS new(id, hash, field_hashes)
+                WHERE {table}.id = new.id
+                """
+            ).format(table=sql.Identifier(records_model._table)),
+            (list(hashes), list(record_hashes), list(record_field_hashes)),
+        )
+        records_model.invalidate_model(["hash", "field_hashes"])
+
+    def _detect_product_changes(self, cwa_products, supplier_infos, supplier_info_vals):
+        """
+        Create or update a change record for every product template affected
+        by the new values of the supplier infos. The templates and existing
+        change records of all products are searched at once, existing change
+        records receiving identical changes are written together and the
+        missing ones created at once.
+        """
+        product_tmpl_model = self.env["product.template"]
+        templates_by_eancode = defaultdict(product_tmpl_model.browse)
+        eancodes = cwa_products.filtered("eancode").mapped("eancode")
+        if eancodes:
+            for product_tmpl in product_tmpl_model.search(
+                [("eancode", "in", eancodes)]
+            ):
+                templates_by_eancode[product_tmpl.eancode] |= product_tmpl
+        templates_by_unique_id = defaultdict(product_tmpl_model.browse)
+        unique_ids = cwa_products.filtered(lambda p: not p.eancode).mapped("unique_id")
+        if unique_ids:
+            for product_tmpl in product_tmpl_model.search(
+                [("unique_id", "in", unique_ids)]
+            ):
+                templates_by_unique_id[product_tmpl.unique_id] |= product_tmpl
+
+        cwa_import_product_change_model = self.env["cwa.import.product.change"]
+        # Try to find the existing change models
+        existing_changes = defaultdict(cwa_import_product_change_model.browse)
+        for change in cwa_import_product_change_model.search(
+            [("source_cwa_product_id", "in", cwa_products.ids)]
+        ):
+            existing_changes[change.source_cwa_product_id.id] |= change
+
+        vals_to_create = []
+        # Existing change records receiving identical changes are written
+        # together
+        vals_by_group = {}
+        changes_by_group = defaultdict(cwa_import_product_change_model.browse)
+        for cwa_product in cwa_products:
+            if cwa_product.eancode:
+                product_tmpl = templates_by_eancode[cwa_product.eancode]
+            else:
+                product_tmpl = templates_by_unique_id[cwa_product.unique_id]
+            if not product_tmpl:
+                continue
+            supplier_info = supplier_infos[cwa_product.unique_id]
+            changes = self._get_value_changes(
+                supplier_info_vals[cwa_product.id], supplier_info
+            )
             state = "new"
             if product_tmpl.preferred_supplier_id and (
                 supplier_info.id != product_tmpl.preferred_supplier_id.id
@@ -264,14 +475,41 @@ class CwaProduct(models.Model):
                 "source_cwa_product_id": cwa_product.id,
                 "value_changes": changes,
             }
-            # Try to find an existing change model
-            existing = cwa_import_product_change_model.search(
-                [("source_cwa_product_id", "=", cwa_product.id)]
-            )
-            if existing:
-                existing.write(new_vals)
-            else:
-                cwa_import_product_change_model.create(new_vals)
+            existing = existing_changes[cwa_product.id]
+            if not existing:
+                vals_to_create.append(new_vals)
+            for change in existing:
+                current_vals = {
+                    "state": change.state,
+                    "affected_product_id": change.affected_product_id.id,
+                    "source_cwa_product_id": change.source_cwa_product_id.id,
+                    "value_changes": change.value_changes,
+                }
+                changed_vals = {
+                    key: value
+                    for key, value in new_vals.items()
+                    if current_vals[key] != value
+                }
+                if changed_vals:
+                    group = json.dumps(changed_vals, sort_keys=True, default=str)
+                    vals_by_group[group] = changed_vals
+                    changes_by_group[group] |= change
+        for group, change_records in changes_by_group.items():
+            change_records.write(vals_by_group[group])
+        if vals_to_create:
+            cwa_import_product_change_model.create(vals_to_create)
+
+    @api.model
+    def _to_supplier_info_value(self, supplier_info, key, value):
+        """
+        Convert a value of a cwa product to the type of the supplier info
+        field, e.g. the Char bewaartemperatuur to the Integer
+        storage_temperature, so that it can be compared to the current value.
+        """
+        try:
+            return supplier_info._fields[key].convert_to_cache(value, supplier_info)
+        except ValueError:
+            return value
 
     def _get_value_changes(self, new_vals, supplier_info):
         changes = {}
@@ -279,72 +517,472 @@ class CwaProduct(models.Model):
             for field in new_vals:
                 old_value = getattr(supplier_info, field, None)
                 new_value = new_vals[field]
-                if old_value != new_value:
+                if old_value != self._to_supplier_info_value(
+                    supplier_info, field, new_value
+                ):
                     changes[field] = {"old": old_value, "new": new_value}
         return changes
 
     @api.model
     def load_records(self, keys, data, model):
-        data_chunks = split_data(data, split_size=CHUNKSIZE)
+        """
+        Load records through the ORM in chunks. A chunk that fails is split
+        in halves until the offending rows are isolated: the good rows are
+        loaded and every bad row is recorded as a cwa.import.error. The chunk
+        size doubles after each clean chunk and starts over after a failure.
+        """
         count_successful = 0
-        for data_subset in data_chunks:
-            for attempt in range(5):
-                use_fresh_cursor = self.env.context.get("new_cursor", False)
-                if use_fresh_cursor:
-                    _logger.info("new cursor created")
-                    new_cr = self.pool.cursor()
-                    uid, context = self.env.uid, self.env.context
-                    env = api.Environment(new_cr, uid, context)
-                else:
-                    env = self.env
+        chunk_size = CHUNKSIZE
+        position = 0
+        while position < len(data):
+            data_subset = data[position : position + chunk_size]
+            position += len(data_subset)
+            loaded, failed = self._load_chunk_bisecting(keys, data_subset, model)
+            count_successful += loaded
+            if failed:
+                chunk_size = CHUNKSIZE
+            else:
+                chunk_size = min(chunk_size * 2, MAX_CHUNKSIZE)
+        return count_successful
 
-                try:
-                    x = env[model].load(keys, data_subset)
-                    if len(x["messages"]) > 0:
-                        _logger.warning("attempt..%s" % attempt)
-                        _logger.error(x)
-                        continue
-                    else:
-                        _logger.warning("success..%s" % attempt)
-                        if use_fresh_cursor:
-                            env.cr.commit()
-                        count_successful += len(x["ids"])
-                        break
-
-                finally:
-                    if use_fresh_cursor:
-                        env.cr.close()
+    def _load_chunk_bisecting(self, keys, data_subset, model):
+        ids, messages = self._load_chunk(keys, data_subset, model)
+        if ids:
+            return len(ids), 0
+        if len(data_subset) == 1:
+            self._log_load_error(keys, data_subset[0], messages, model)
+            return 0, 1
+        middle = len(data_subset) // 2
+        loaded_left, failed_left = self._load_chunk_bisecting(
+            keys, data_subset[:middle], model
+        )
+        loaded_right, failed_right = self._load_chunk_bisecting(
+            keys, data_subset[middle:], model
+        )
+        return loaded_left + loaded_right, failed_left + failed_right
 
-        return count_successful
+    def _load_chunk(self, keys, data_subset, model):
+        use_fresh_cursor = self.env.context.get("new_cursor", False)
+        if use_fresh_cursor:
+            _logger.info("new cursor created")
+            new_cr = self.pool.cursor()
+            uid, context = self.env.uid, self.env.context
+            env = api.Environment(new_cr, uid, context)
+        else:
+            env = self.env
+
+        try:
+            result = env[model].load(keys, data_subset)
+            if result["ids"] and use_fresh_cursor:
+                env.cr.commit()
+        finally:
+            if use_fresh_cursor:
+                env.cr.close()
+        return result["ids"] or [], result["messages"]
+
+    def _log_load_error(self, keys, values, messages, model):
+        record = dict(zip(keys, values, strict=True))
+        message = "\n".join(msg["message"] for msg in messages)
+        _logger.error("Could not load %s: %s", record.get("unique_id"), message)
+        self.env["cwa.import.error"].log_error(
+            record.get("unique_id"), message, model, values=record
+        )
+
+    @api.model
+    def bulk_load_records(self, keys, data, model):
+        """
+        Insert new records in bulk: the rows are converted and validated
+        like the ORM load does, streamed into a staging table with COPY and
+        moved into the model's table with a single INSERT ... SELECT.
+        Rows that fail to convert are reported one by one and skipped.
+        When the bulk insert itself fails, the ORM load is used instead.
+        """
+        records_model = self.env[model]
+        rows, valid_data = self._convert_rows_for_bulk_load(keys, data, records_model)
+        if not rows:
+            return 0
+        try:
+            with self.env.cr.savepoint():
+                ids = self._copy_rows_into_table(keys, rows, records_model)
+        except psycopg2.Error as err:
+            _logger.warning("Bulk load failed, falling back to ORM load: %s", err)
+            return self.load_records(keys, valid_data, model)
+        return len(ids)
+
+    def _convert_rows_for_bulk_load(self, keys, data, records_model):
+        converter = self.env["ir.fields.converter"].for_model(records_model)
+        fields_to_load = [records_model._fields[key] for key in keys]
+        rows = []
+        valid_data = []
+        for values in data:
+            errors = []
+
+            def log(field, exception, errors=errors):
+                if not isinstance(exception, Warning):
+                    errors.append({"message": f"{field}: {exception}"})
+
+            converted = converter(dict(zip(keys, values, strict=True)), log)
+            if errors:
+                self._log_load_error(keys, values, errors, records_model._name)
+                continue
+            rows.append(
+                [
+                    field.convert_to_column(converted.get(field.name), records_model)
+                    for field in fields_to_load
+                ]
+            )
+            valid_data.append(values)
+        return rows, valid_data
+
+    def _copy_rows_into_table(self, keys, rows, records_model):
+        cr = self.env.cr
+        table = records_model._table
+        defaults = {
+            name: records_model._fields[name].convert_to_column(value, records_model)
+            for name, value in records_model.default_get(
+                list(records_model._fields)
+            ).items()
+            if name not in keys
+            and records_model._fields[name].store
+            and records_model._fields[name].column_type
+        }
+        columns = sql.SQL(", ").join(map(sql.Identifier, keys))
+        # left behind when an earlier load of the transaction failed halfway
+        cr.execute("DROP TABLE IF EXISTS cwa_load_staging")
+        cr.execute(
+            sql.SQL(
+                "CREATE TEMP TABLE cwa_load_staging ON COMMIT DROP AS "
+                "SELECT {} FROM {} WITH NO DATA"
+            ).format(columns, sql.Identifier(table))
+        )
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join(map(copy_text_value, row)))
+            buffer.write("\n")
+        buffer.seek(0)
+        cr.copy_expert(
+            sql.SQL("COPY cwa_load_staging ({}) FROM STDIN").format(columns),
+            buffer,
+        )
+        insert_columns = [sql.Identifier(name) for name in [*keys, *defaults]]
+        select_values = [sql.Identifier(name) for name in keys]
+        select_values += [sql.Literal(value) for value in defaults.values()]
+        cr.execute(
+            sql.SQL(
+                """
+                INSERT INTO {} ({}, create_uid, create_date, write_uid, write_date)
+                SELECT {}, {uid}, now() at time zone 'UTC',
+                    {uid}, now() at time zone 'UTC'
+                FROM cwa_load_staging
+                RETURNING id
+                """
+            ).format(
+                sql.Identifier(table),
+                sql.SQL(", ").join(insert_columns),
+                sql.SQL(", ").join(select_values),
+                uid=sql.Literal(self.env.uid),
+            )
+        )
+        ids = [row[0] for row in cr.fetchall()]
+        cr.execute("DROP TABLE cwa_load_staging")
+        return ids
 
     @api.model
     def delete_records(self, unique_ids, model):
-        for unique_id in unique_ids:
-            self.env[model].search([("unique_id", "=", unique_id)]).unlink()
+        records = (
+            self.env[model]
+            .with_context(active_test=False)
+            .search([("unique_id", "in", list(unique_ids))])
+        )
+        if self._archive_removed_products():
+            records.write({"active": False})
+        else:
+            records.unlink()
         return len(unique_ids)
 
     @api.model
-    def import_xml_products(self, prod_file):
+    def _archive_removed_products(self):
+        return bool(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cwa_archive_removed_products", default=False)
+        )
+
+    @api.model
+    def import_xml_products(self, prod_file, force=False):
+        if not prod_file and self._ftp_pipelined_import():
+            return self._import_xml_products_pipelined(force=force)
+        phases = PhaseRecorder(self.env.cr)
+        if not prod_file:
+            with phases.measure("fetch"):
+                prod_file = self._get_prod_file_from_ftp()
+        if not prod_file:
+            _logger.error("XML file not found!")
+            return
+
+        fingerprint = self.env["cwa.import.run"].get_file_fingerprint(prod_file)
+        run = self._start_import_run(fingerprint, force)
+        if not run:
+            return 0
+
+        loader = XMLProductLoader(self.env["cwa.product"])
+        loader.phases = phases
+        with phases.measure("parse") as phase:
+            parsed_records = self._parse_feed(loader, prod_file)
+            phase["rows"] = len(loader.new_unique_ids)
+        run.unknown_tags = dict(loader.unknown_tags) or False
+        return self._apply_parsed_records(run, *parsed_records, phases=phases)
+
+    @api.model
+    def dry_run_xml_products(self, prod_file=False):
+        """
+        Report what importing a feed would do, without writing anything: the
+        feed is parsed and compared with the existing records like a real
+        import, and only the outcome is counted.
+        """
         if not prod_file:
             prod_file = self._get_prod_file_from_ftp()
         if not prod_file:
             _logger.error("XML file not found!")
             return
 
-        keys, to_load, to_update, to_delete = self.parse_from_xml(prod_file)
+        loader = XMLProductLoader(self.env["cwa.product"])
+        _keys, to_load, to_update, to_delete = self._parse_feed(loader, prod_file)
+        # revived records carry all their fields, not just the changed ones
+        to_change = [values for values in to_update if "active" not in values]
+        field_changes = Counter(
+            name for values in to_change for name in values if name not in RECORD_KEYS
+        )
+        return {
+            "file": os.path.basename(prod_file),
+            "products": len(loader.new_unique_ids),
+            "to_create": len(to_load),
+            "to_update": len(to_change),
+            "to_revive": len(to_update) - len(to_change),
+            "to_delete": len(to_delete),
+            "unchanged": len(loader.new_unique_ids) - len(to_load) - len(to_update),
+            "field_changes": dict(field_changes.most_common()),
+            "price_movers": self._get_price_movers(to_change),
+            "delete_unique_ids": sorted(to_delete),
+            "unknown_tags": dict(loader.unknown_tags),
+        }
+
+    @api.model
+    def _get_price_movers(self, to_change):
+        """Return the largest relative price changes among the changed records"""
+        new_prices = {
+            values["unique_id"]: values
+            for values in to_change
+            if any(name in values for name in PRICE_FIELDS)
+        }
+        if not new_prices:
+            return []
+        self.flush_model(["unique_id", *PRICE_FIELDS])
+        self.env.cr.execute(
+            "SELECT unique_id, inkoopprijs, consumentenprijs FROM cwa_product "
+            "WHERE unique_id = ANY(%s)",
+            (list(new_prices),),
+        )
+        movers = []
+        for unique_id, *old_prices in self.env.cr.fetchall():
+            for name, old_price in zip(PRICE_FIELDS, old_prices, strict=True):
+                new_price = new_prices[unique_id].get(name)
+                if new_price is None:
+                    continue
+                old_price = old_price or 0.0
+                new_price = float(new_price)
+                if new_price == old_price:
+                    continue
+                change_pct = None
+                if old_price:
+                    change_pct = round((new_price - old_price) / old_price * 100, 2)
+                movers.append(
+                    {
+                        "unique_id": unique_id,
+                        "field": name,
+                        "old": old_price,
+                        "new": new_price,
+                        "change_pct": change_pct,
+                    }
+                )
+
+        def size_of_change(mover):
+            # a price that was zero moved the most
+            if mover["change_pct"] is None:
+                return float("inf")
+            return abs(mover["change_pct"])
+
+        movers.sort(
+            key=lambda mover: (
+                -size_of_change(mover),
+                mover["unique_id"],
+                mover["field"],
+            )
+        )
+        return movers[:DRY_RUN_PRICE_MOVERS]
+
+    @api.model
+    def _parse_feed(self, loader, prod_file):
+        """
+        Parse a feed file with the reader matching its format. Downloaded
+        feeds get a snapshot of the parsed records next to them, so parsing
+        the same feed again only has to read the snapshot.
+        """
+        snapshot_path = False
+        if self._is_cached_feed(prod_file):
+            snapshot_path = get_snapshot_path(prod_file)
+            snapshot = read_snapshot(snapshot_path)
+            if snapshot:
+                _logger.info("Using the parsed snapshot of %s", prod_file)
+                records, unknown_tags = snapshot
+                loader.unknown_tags.update(unknown_tags)
+                return loader.parse_records(records)
+            loader.parsed_records = []
+
+        reader = get_feed_reader(prod_file)
+        workers = self._get_parse_workers()
+        if reader is not XMLFeedReader:
+            parsed_records = loader.parse_from_reader(prod_file, reader)
+        elif workers > 1:
+            parsed_records = loader.parse_from_xml_parallel(prod_file, workers)
+        else:
+            parsed_records = loader.parse_from_xml(prod_file)
+        if snapshot_path:
+            write_snapshot(snapshot_path, loader.parsed_records, loader.unknown_tags)
+            loader.parsed_records = None
+        return parsed_records
+
+    @api.model
+    def _is_cached_feed(self, prod_file):
+        return os.path.dirname(os.path.realpath(prod_file)) == os.path.realpath(
+            self._get_feed_cache_dir()
+        )
+
+    @api.model
+    def _ftp_pipelined_import(self):
+        return bool(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cwa_ftp_pipelined_import", default=False)
+        )
+
+    @api.model
+    def _get_parse_workers(self):
+        return int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cwa_parse_workers", default=0)
+        )
+
+    @api.model
+    def _start_import_run(self, fingerprint, force):
+        """
+        Register the import run, or a skipped run if the feed is unchanged.
+        Nothing is registered when another import is running.
+        """
+        run_model = self.env["cwa.import.run"]
+        if not run_model.acquire_import_lock():
+            _logger.info("Skipping import of %s", fingerprint["name"])
+            return
+        if not force and run_model.is_feed_unchanged(fingerprint):
+            _logger.info("Feed %s is unchanged, skipping import", fingerprint["name"])
+            run_model.create(dict(fingerprint, state="skipped"))
+            return
+        return run_model.create(
+            dict(fingerprint, forced=force, lock_holder=run_model.get_lock_holder())
+        )
+
+    @api.model
+    def _apply_parsed_records(
+        self, run, keys, to_load, to_update, to_delete, phases=None
+    ):
+        """
+        Write the outcome of a parse and close the run, storing the time,
+        queries and rows of every phase on it.
+        """
+        if phases is None:
+            phases = PhaseRecorder(self.env.cr)
         count = 0
+        # only the touched products need their prices compared
+        touched_unique_ids = [values["unique_id"] for values in to_update]
         if to_load:
-            count += self.load_records(keys, to_load, "cwa.product")
+            unique_id_index = keys.index("unique_id")
+            touched_unique_ids += [values[unique_id_index] for values in to_load]
+            with phases.measure("load") as phase:
+                phase["rows"] = self._load_new_records(keys, to_load)
+            count += phase["rows"]
         if to_update:
-            count += self.update_records(to_update, "cwa.product")
+            with phases.measure("update") as phase:
+                phase["rows"] = self.update_records(to_update, "cwa.product")
+            count += phase["rows"]
         if to_delete:
-            count += self.delete_records(to_delete, "cwa.product")
+            with phases.measure("delete") as phase:
+                phase["rows"] = self.delete_records(to_delete, "cwa.product")
+            count += phase["rows"]
 
-        supplierinfo = self.env["product.supplierinfo"].search([], limit=500)
-        if supplierinfo:  # Only compare prices if we have records
-            supplierinfo.compare_prices()
+        with phases.measure("compare_prices") as phase:
+            phase["rows"] = self._compare_supplier_prices(touched_unique_ids)
+        run.record_phases(phases)
+        run.mark_done(count)
         return count
 
+    @api.model
+    def _load_new_records(self, keys, to_load):
+        """Load new products in bulk, or through the ORM with cwa_orm_load"""
+        if self.env.context.get("cwa_orm_load"):
+            return self.load_records(keys, to_load, "cwa.product")
+        return self.bulk_load_records(keys, to_load, "cwa.product")
+
+    @api.model
+    def compare_all_supplier_prices(self):
+        """
+        Reconcile the supplier prices of the whole catalog, where imports
+        only compare the products they touched.
+        """
+        if not self.env["cwa.import.run"].acquire_import_lock():
+            _logger.info("Skipping the comparison of all supplier prices")
+            return 0
+        return self._compare_supplier_prices()
+
+    @api.model
+    def _compare_supplier_prices(self, unique_ids=None):
+        """
+        Compare the supplier prices of the given unique_ids, or of all CWA
+        supplier infos. Return the number of unique_ids compared.
+        """
+        supplierinfo_model = self.env["product.supplierinfo"]
+        if unique_ids is None:
+            count = supplierinfo_model.search_count([("cwa", "=", True)])
+        else:
+            unique_ids = set(unique_ids)
+            count = len(unique_ids)
+        if count:  # Only compare prices if we have records
+            supplierinfo_model.compare_prices(unique_ids)
+        return count
+
+    @api.model
+    def enqueue_xml_products_import(self, prod_file=False, force=False):
+        """
+        Import a feed as a graph of jobs instead of in one transaction: a
+        job parses the feed into chunks stored on the import run, every
+        chunk is loaded, updated or deleted by a job of its own and a last
+        job compares the prices. A run that stopped half way can be resumed
+        from its pending chunks.
+        """
+        if not prod_file:
+            prod_file = self._get_prod_file_from_ftp()
+        if not prod_file:
+            _logger.error("XML file not found!")
+            return
+
+        fingerprint = self.env["cwa.import.run"].get_file_fingerprint(prod_file)
+        run = self._start_import_run(fingerprint, force)
+        if not run:
+            return
+        run.write({"pipeline": True, "feed_path": prod_file})
+        run.with_delay(description=f"Parse CWA feed {run.name}").job_parse_feed()
+        return run
+
     @api.model
     def import_demo_xml_products(self):
         path = os.path.dirname(os.path.realpath(__file__))
@@ -721,19 +1359,58 @@ class CwaProduct(models.Model):
 
     @api.depends("leveranciernummer")
     def _compute_vendor_id(self):
+        suppliers = self.env["cwa.product.suppliers"].search(
+            [("leveranciernummer", "in", list(set(self.mapped("leveranciernummer"))))]
+        )
+        partners = {
+            supplier.leveranciernummer: supplier.res_partner_id
+            for supplier in suppliers
+        }
         for this in self:
-            supplier = (
-                self.env["cwa.product.suppliers"]
-                .search([("leveranciernummer", "=", this.leveranciernummer)])
-                .res_partner_id
-            )
-            this.vendor_id = supplier.id
+            this.vendor_id = partners.get(this.leveranciernummer, False)
 
     @api.model
     def _search_vendor_id(self, operator, value):
         pass
 
     def _get_prod_file_from_ftp(self):
+        """
+        Fetch the latest 'Artikelen' feed from the FTP server. Downloaded
+        feeds are cached locally by remote name, size and modification time,
+        so a feed that did not change is never downloaded again. Interrupted
+        downloads are resumed where they stopped.
+        """
+        local = False
+        try:
+            ftp_server = self._connect_ftp()
+            if not ftp_server:
+                return
+            remote_feed = self._find_remote_feed(ftp_server)
+            if not remote_feed:
+                return
+            name, size, mtime = remote_feed
+            if size is None or mtime is None:
+                local = self._get_uncached_feed_path(name)
+            else:
+                local = self._get_cached_feed_path(name, size, mtime)
+            if os.path.exists(local) and self._is_cached_feed(local):
+                _logger.info("Feed %s is unchanged, using cached %s", name, local)
+            else:
+                remote = f"/{FTP_ROOT}/{name}"
+                try:
+                    self._download_feed(ftp_server, remote, local, size, mtime)
+                except ftplib.error_perm as err:
+                    _logger.error("Downloading Failed!!: %s", err)
+                    return
+            ftp_server.quit()
+        except ftplib.all_errors as err:
+            _logger.error("Failed to Download from FTP: %s", err)
+            return
+        return local
+
+    @api.model
+    def _connect_ftp(self):
+        """Log in on the FTP server and go into the feed directory"""
         ir_config = self.env["ir.config_parameter"].sudo()
         config_address = tools.config.get("ftp_address", False)
         if ir_config.get_param("cwa_enable_ftp_import", default=False):
@@ -750,32 +1427,314 @@ class CwaProduct(models.Model):
         if not host or not username or not passwd:
             return
 
-        tmp = False
+        ftp_server = ftplib.FTP(host, username, passwd, timeout=20)
+        ftp_server.encoding = "utf-8"
+        # Go into the Root Directory
+        ftp_server.cwd(FTP_ROOT)
+        return ftp_server
+
+    @api.model
+    def _find_remote_feed(self, ftp_server):
+        """Return (name, size, mtime) of the latest 'Artikelen' feed"""
+        # ignore Actie files
+        remote_feeds = [
+            feed
+            for feed in self._list_remote_files(ftp_server)
+            if "Artikelen" in feed[0]
+        ]
+        # pick the latest if there are files
+        if not remote_feeds:
+            _logger.error("Directory '%s' is empty!", FTP_ROOT)
+            return
+        name, size, mtime = remote_feeds[-1]
+        if size is None or mtime is None:
+            size, mtime = self._get_remote_file_facts(ftp_server, name)
+        return name, size, mtime
+
+    @api.model
+    def _import_xml_products_pipelined(self, force=False):
+        """
+        Download the latest feed and parse it while it comes in: every block
+        received from the FTP server is handed to an incremental parser, so
+        parsing and hashing overlap with the transfer instead of following
+        it. A copy of the feed is only written to disk when
+        'cwa_ftp_keep_feed_copy' is set.
+        """
+        run = False
         try:
-            ftp_server = ftplib.FTP(host, username, passwd, timeout=20)
-            ftp_server.encoding = "utf-8"
-            root = "VoorWinkel"
-            # Go into the Root Directory
-            ftp_server.cwd(root)
-            files_in_dir = ftp_server.nlst()
-            # ignore Actie files
-            files_in_dir = [x for x in files_in_dir if "Artikelen" in x]
-            # pick the latest if there are files
-            if not files_in_dir:
-                _logger.error("Directory '%s' is empty!" % root)
+            ftp_server = self._connect_ftp()
+            if not ftp_server:
+                _logger.error("XML file not found!")
                 return
-            remote = f"/{root}/{files_in_dir[-1]}"
-            tmp = "/tmp/products_data.xml"
-            with open(tmp, "wb") as file:
-                _logger.info(f"Downloading file: {remote} >>>> {tmp}")
-                try:
-                    ftp_server.retrbinary("RETR %s" % remote, file.write)
-                    _logger.info("File successfully downloaded....proceed with Import!")
-                except ftplib.error_perm as err:
-                    _logger.error("Downloading Failed!!: %s" % err)
-                    return
-
+            remote_feed = self._find_remote_feed(ftp_server)
+            if not remote_feed:
+                return
+            name, size, mtime = remote_feed
+            if size is None or mtime is None:
+                # nothing to recognise the feed by, download it as a whole
+                local = self._get_uncached_feed_path(name)
+                self._download_feed(ftp_server, f"/{FTP_ROOT}/{name}", local)
+                ftp_server.quit()
+                return self.import_xml_products(local, force=force)
+            # locked before the parse reads the hashes of the existing products
+            if not self._start_remote_import(name, size, mtime, force):
                 ftp_server.quit()
+                return 0
+            local = self._get_cached_feed_path(name, size, mtime)
+            if os.path.exists(local):
+                ftp_server.quit()
+                _logger.info("Feed %s is unchanged, using cached %s", name, local)
+                return self.import_xml_products(local, force=force)
+            if get_feed_reader_by_name(name) not in (None, XMLFeedReader):
+                # only XML can be parsed while it comes in
+                self._download_feed(
+                    ftp_server, f"/{FTP_ROOT}/{name}", local, size, mtime
+                )
+                ftp_server.quit()
+                return self.import_xml_products(local, force=force)
+
+            run_model = self.env["cwa.import.run"]
+            run = run_model.create(
+                {
+                    "name": name,
+                    "file_size": size,
+                    "remote_mtime": mtime,
+                    "forced": force,
+                    "lock_holder": run_model.get_lock_holder(),
+                }
+            )
+            loader = XMLProductLoader(self.env["cwa.product"])
+            loader.phases = PhaseRecorder(self.env.cr)
+            loader.start_incremental_parse()
+            keep_copy = self._keep_feed_copy()
+            if keep_copy:
+                loader.parsed_records = []
+            sha256 = hashlib.sha256()
+            partial = local + ".part"
+            received = 0
+            copy_file = (
+                self._open_partial_download(partial, truncate=True)
+                if keep_copy
+                else nullcontext()
+            )
+            with copy_file as copy:
+
+                def handle_block(block):
+                    nonlocal received
+                    received += len(block)
+                    sha256.update(block)
+                    loader.feed(block)
+                    if copy:
+                        copy.write(block)
+
+                _logger.info("Downloading and parsing file: %s", name)
+                # the products are parsed while they come in
+                with loader.phases.measure("fetch") as phase:
+                    ftp_server.retrbinary(f"RETR /{FTP_ROOT}/{name}", handle_block)
+                    phase["rows"] = len(loader.new_unique_ids)
+                if copy:
+                    # moved while still locked
+                    self._store_feed_copy(partial, local, mtime, received == size)
+            ftp_server.quit()
         except ftplib.all_errors as err:
-            _logger.error("Failed to Download from FTP: %s" % err)
-        return tmp
+            _logger.error("Failed to Download from FTP: %s", err)
+            if run:
+                run.mark_failed(err)
+            return
+        if received != size:
+            _logger.error("Incomplete download of %s", name)
+            run.mark_failed(f"Incomplete download of {name}")
+            return
+
+        fingerprint = {
+            "name": name,
+            "file_sha256": sha256.hexdigest(),
+            "file_size": received,
+            "remote_mtime": mtime,
+        }
+        if not force and run_model.is_feed_unchanged(fingerprint):
+            _logger.info("Feed %s is unchanged, skipping import", name)
+            run.write(dict(fingerprint, state="skipped"))
+            return 0
+        run.write(fingerprint)
+        with loader.phases.measure("parse") as phase:
+            parsed_records = loader.finish_incremental_parse()
+            phase["rows"] = len(loader.new_unique_ids)
+        if keep_copy:
+            write_snapshot(
+                get_snapshot_path(local), loader.parsed_records, loader.unknown_tags
+            )
+            loader.parsed_records = None
+        run.unknown_tags = dict(loader.unknown_tags) or False
+        return self._apply_parsed_records(run, *parsed_records, phases=loader.phases)
+
+    @api.model
+    def _start_remote_import(self, name, size, mtime, force):
+        """
+        Take the import lock for a remote feed before it is downloaded.
+        Return False when the import is skipped: another import is running,
+        or the feed did not change since the last import.
+        """
+        run_model = self.env["cwa.import.run"]
+        if not run_model.acquire_import_lock():
+            _logger.info("Skipping import of %s", name)
+            return False
+        if not force and run_model.is_remote_feed_unchanged(name, size, mtime):
+            _logger.info("Feed %s is unchanged, skipping import", name)
+            run_model.create(
+                {
+                    "name": name,
+                    "file_size": size,
+                    "remote_mtime": mtime,
+                    "state": "skipped",
+                }
+            )
+            return False
+        return True
+
+    @api.model
+    def _keep_feed_copy(self):
+        return bool(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cwa_ftp_keep_feed_copy", default=False)
+        )
+
+    @api.model
+    def _list_remote_files(self, ftp_server):
+        """
+        Return (name, size, mtime) for every file in the current directory.
+        Size and mtime are None when the server does not support MLSD.
+        """
+        try:
+            return [
+                (
+                    name,
+                    int(facts["size"]) if "size" in facts else None,
+                    parse_ftp_timestamp(facts["modify"]) if "modify" in facts else None,
+                )
+                for name, facts in ftp_server.mlsd(facts=["type", "size", "modify"])
+                if facts.get("type", "file") == "file"
+            ]
+        except ftplib.error_perm:
+            return [(name, None, None) for name in ftp_server.nlst()]
+
+    @api.model
+    def _get_remote_file_facts(self, ftp_server, name):
+        """
+        Return the size and mtime of a remote file, both None when the
+        server does not support SIZE or MDTM
+        """
+        try:
+            ftp_server.voidcmd("TYPE I")
+            size = ftp_server.size(name)
+            response = ftp_server.voidcmd(f"MDTM {name}")
+            return size, parse_ftp_timestamp(response.split()[-1])
+        except (ftplib.error_perm, ValueError) as err:
+            _logger.warning(
+                "No size or modification time for %s, it is downloaded without "
+                "change detection: %s",
+                name,
+                err,
+            )
+            return None, None
+
+    @api.model
+    def _get_feed_cache_dir(self):
+        cache_dir = tools.config.get("cwa_feed_cache_dir") or os.path.join(
+            tools.config["data_dir"], "cwa_feeds"
+        )
+        os.makedirs(cache_dir, exist_ok=True)
+        return cache_dir
+
+    @api.model
+    def _get_cached_feed_path(self, name, size, mtime):
+        base, extension = os.path.splitext(os.path.basename(name))
+        return os.path.join(
+            self._get_feed_cache_dir(),
+            f"{base}-{size}-{mtime:%Y%m%d%H%M%S}{extension}",
+        )
+
+    @api.model
+    def _get_uncached_feed_path(self, name):
+        """Where to download a feed that cannot be cached, for lack of facts"""
+        return os.path.join(tempfile.gettempdir(), f"cwa_{os.path.basename(name)}")
+
+    @api.model
+    def _download_feed(self, ftp_server, remote, local, size=None, mtime=None):
+        partial = local + ".part"
+        with self._open_partial_download(partial) as file:
+            offset = os.fstat(file.fileno()).st_size
+            # a download can only be resumed when the size of the feed is known
+            if size is None or offset > size:
+                file.truncate(0)
+                offset = 0
+            if offset:
+                _logger.info("Resuming download of %s at byte %s", remote, offset)
+            else:
+                _logger.info("Downloading file: %s >>>> %s", remote, local)
+            ftp_server.retrbinary(f"RETR {remote}", file.write, rest=offset or None)
+            file.flush()
+            if size is not None and os.path.getsize(partial) != size:
+                # never resume from a broken partial download
+                os.remove(partial)
+                raise ftplib.error_temp(f"Incomplete download of {remote}")
+            os.replace(partial, local)
+        if mtime is not None:
+            # keep the remote modification time, it ends up on the import run
+            timestamp = mtime.replace(tzinfo=datetime.timezone.utc).timestamp()
+            os.utime(local, (timestamp, timestamp))
+        if self._is_cached_feed(local):
+            self._prune_feed_cache(keep=local)
+        _logger.info("File successfully downloaded....proceed with Import!")
+
+    @api.model
+    def _open_partial_download(self, partial, truncate=False):
+        """
+        Open a partial download for appending, locked against other
+        processes downloading the same feed at the same time.
+        """
+        file = open(partial, "ab")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # the file may have been completed and moved before it was locked
+            if not os.path.samestat(os.fstat(file.fileno()), os.stat(partial)):
+                raise FileNotFoundError(partial)
+        except OSError as err:
+            file.close()
+            raise ftplib.error_temp(
+                f"{partial} is being downloaded by another import"
+            ) from err
+        if truncate:
+            file.truncate(0)
+        return file
+
+    @api.model
+    def _store_feed_copy(self, partial, local, mtime, complete):
+        """Move a complete copy of a feed into the cache, discard it otherwise"""
+        if not complete:
+            os.remove(partial)
+            return
+        os.replace(partial, local)
+        timestamp = mtime.replace(tzinfo=datetime.timezone.utc).timestamp()
+        os.utime(local, (timestamp, timestamp))
+        self._prune_feed_cache(keep=local)
+
+    @api.model
+    def _prune_feed_cache(self, keep):
+        cache_dir = os.path.dirname(keep)
+        cached = sorted(
+            (
+                os.path.join(cache_dir, name)
+                for name in os.listdir(cache_dir)
+                if not name.endswith((".part", ".snapshot"))
+            ),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+        for path in cached[FEED_CACHE_SIZE:]:
+            if path != keep:
+                os.remove(path)
+                snapshot_path = get_snapshot_path(path)
+                if os.path.exists(snapshot_path):
+                    os.remove(snapshot_path)
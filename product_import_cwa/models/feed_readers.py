@@ -0,0 +1,109 @@
+"""
+Readers for the formats a product feed can be delivered in.
+
+A reader yields a tag -> value mapping per product, with the tags of the
+XML feed as keys, so XMLProductLoader converts, hashes and compares the
+products the same way whatever the format.
+"""
+import csv
+import json
+import os
+
+from .utils import XMLProductLoader
+
+# Bytes read to sniff the format or CSV dialect of a feed
+SNIFF_SIZE = 4096
+
+
+class XMLFeedReader:
+    name = "xml"
+    extensions = (".xml",)
+
+    @staticmethod
+    def sniff(head):
+        return head.startswith(b"<")
+
+    @staticmethod
+    def iter_products(prod_file):
+        encoding = XMLProductLoader.detect_encoding(prod_file)
+        for product in XMLProductLoader.iter_products(prod_file, encoding=encoding):
+            yield {item.tag: item.text for item in product}
+
+
+class CSVFeedReader:
+    """CSV with a header row naming the tags, UTF-8 encoded"""
+
+    name = "csv"
+    extensions = (".csv", ".txt")
+
+    @staticmethod
+    def sniff(head):
+        return True
+
+    @staticmethod
+    def iter_products(prod_file):
+        with open(prod_file, encoding="utf-8-sig", newline="") as file:
+            try:
+                dialect = csv.Sniffer().sniff(file.read(SNIFF_SIZE), delimiters=",;\t|")
+            except csv.Error:
+                # a single column, or too odd to tell
+                dialect = csv.excel
+            file.seek(0)
+            for row in csv.DictReader(file, dialect=dialect):
+                # cells missing from a short row come back as None
+                yield {tag: value for tag, value in row.items() if tag is not None}
+
+
+class JSONLinesFeedReader:
+    """One JSON object per line, keyed by tag"""
+
+    name = "jsonl"
+    extensions = (".jsonl", ".ndjson")
+
+    @staticmethod
+    def sniff(head):
+        return head.startswith(b"{")
+
+    @staticmethod
+    def iter_products(prod_file):
+        with open(prod_file, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    yield {
+                        tag: JSONLinesFeedReader.to_text(value)
+                        for tag, value in json.loads(line).items()
+                    }
+
+    @staticmethod
+    def to_text(value):
+        """The text of a value as the XML feed has it, booleans as 1 or 0"""
+        if value is None:
+            return None
+        if isinstance(value, bool):
+            return "1" if value else "0"
+        return str(value)
+
+
+# In sniffing order, CSV accepts anything
+FEED_READERS = (XMLFeedReader, JSONLinesFeedReader, CSVFeedReader)
+
+
+def get_feed_reader_by_name(name):
+    """Return the reader for a file name's extension, if it is a known one"""
+    extension = os.path.splitext(name)[1].lower()
+    for reader in FEED_READERS:
+        if extension in reader.extensions:
+            return reader
+    return None
+
+
+def get_feed_reader(prod_file):
+    """Pick the reader for a feed by its extension, or else by its content"""
+    reader = get_feed_reader_by_name(prod_file)
+    if reader:
+        return reader
+    with open(prod_file, "rb") as file:
+        head = file.read(SNIFF_SIZE).lstrip(b"\xef\xbb\xbf \t\r\n")
+    for reader in FEED_READERS:
+        if reader.sniff(head):
+            return reader
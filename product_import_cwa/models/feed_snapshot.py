@@ -0,0 +1,170 @@
+"""
+Columnar snapshots of parsed CWA feeds.
+
+A snapshot holds the records XMLProductLoader parsed from a feed, before
+they were compared with the database, so importing the same feed again
+skips the XML parsing. Every field is stored as a table of its distinct
+values and an array of indexes into that table, the record hashes as an
+array of binary digests. Snapshots are read through mmap.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+
+from .utils import FIELDS_TO_LOAD, LOAD_FIELDS, LOADER_VERSION, CwaRecord
+
+_logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"CWASNAP\0"
+SNAPSHOT_FORMAT = 1
+# magic, format, signature, number of records, number of columns
+HEADER = struct.Struct("<8sH32sII")
+UINT32 = struct.Struct("<I")
+DIGEST_SIZE = 16
+# Snapshots written for other fields or another loader are ignored
+SNAPSHOT_SIGNATURE = hashlib.sha256(
+    repr((FIELDS_TO_LOAD, LOADER_VERSION)).encode("utf-8")
+).digest()
+
+HASH_INDEX = LOAD_FIELDS.index("hash")
+
+
+def get_snapshot_path(prod_file):
+    return prod_file + ".snapshot"
+
+
+def _pad(size):
+    return -size % 4
+
+
+def _write_column(file, column):
+    """Write a column as a table of distinct values and uint32 indexes"""
+    table = {}
+    indexes = [
+        0 if value is None else table.setdefault(value, len(table) + 1)
+        for value in column
+    ]
+    offsets = [0]
+    blobs = []
+    for value in table:
+        blob = value.encode("utf-8")
+        blobs.append(blob)
+        offsets.append(offsets[-1] + len(blob))
+    blob = b"".join(blobs)
+    file.write(UINT32.pack(len(table)))
+    file.write(UINT32.pack(len(blob)))
+    file.write(struct.pack(f"<{len(offsets)}I", *offsets))
+    file.write(blob + b"\0" * _pad(len(blob)))
+    file.write(struct.pack(f"<{len(indexes)}I", *indexes))
+
+
+def write_snapshot(path, records, unknown_tags):
+    """Write parsed records and the unknown tags of their feed to a snapshot"""
+    partial = path + ".part"
+    with open(partial, "wb") as file:
+        file.write(
+            HEADER.pack(
+                SNAPSHOT_MAGIC,
+                SNAPSHOT_FORMAT,
+                SNAPSHOT_SIGNATURE,
+                len(records),
+                len(LOAD_FIELDS),
+            )
+        )
+        tags = json.dumps(dict(unknown_tags)).encode("utf-8")
+        file.write(UINT32.pack(len(tags)))
+        file.write(tags + b"\0" * _pad(len(tags)))
+        file.write(
+            b"".join(bytes.fromhex(record.values[HASH_INDEX]) for record in records)
+        )
+        _write_column(file, [str(record.present) for record in records])
+        for index, name in enumerate(LOAD_FIELDS):
+            if name != "hash":
+                _write_column(file, [record.values[index] for record in records])
+    os.replace(partial, path)
+
+
+class _Reader:
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def read(self, size):
+        data = self.view[self.position : self.position + size]
+        if len(data) != size:
+            raise ValueError("Truncated snapshot")
+        self.position += size
+        return data
+
+    def read_uint32(self):
+        return UINT32.unpack(self.read(UINT32.size))[0]
+
+    def read_uint32_array(self, count):
+        return self.read(count * UINT32.size).cast("I")
+
+    def read_column(self, count):
+        table_size = self.read_uint32()
+        blob_size = self.read_uint32()
+        offsets = self.read_uint32_array(table_size + 1)
+        blob = bytes(self.read(blob_size + _pad(blob_size)))
+        table = [None] + [
+            blob[start:end].decode("utf-8")
+            for start, end in zip(offsets[:-1], offsets[1:], strict=True)
+        ]
+        return [table[index] for index in self.read_uint32_array(count)]
+
+
+def read_snapshot(path):
+    """
+    Return the records and unknown tags stored in a snapshot, or None when
+    there is no usable snapshot
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        view = memoryview(data)
+        try:
+            return _read_snapshot(view)
+        except (ValueError, struct.error, UnicodeDecodeError) as err:
+            _logger.warning("Ignoring unreadable snapshot %s: %s", path, err)
+            return None
+        finally:
+            view.release()
+
+
+def _read_snapshot(view):
+    reader = _Reader(view)
+    magic, version, signature, count, columns = HEADER.unpack(reader.read(HEADER.size))
+    if (magic, version, signature, columns) != (
+        SNAPSHOT_MAGIC,
+        SNAPSHOT_FORMAT,
+        SNAPSHOT_SIGNATURE,
+        len(LOAD_FIELDS),
+    ):
+        _logger.info("Snapshot was written for other fields, ignoring it")
+        return None
+    tags_size = reader.read_uint32()
+    unknown_tags = json.loads(
+        bytes(reader.read(tags_size + _pad(tags_size)))[:tags_size]
+    )
+    digests = bytes(reader.read(count * DIGEST_SIZE))
+    hashes = [
+        digests[start : start + DIGEST_SIZE].hex()
+        for start in range(0, len(digests), DIGEST_SIZE)
+    ]
+    masks = reader.read_column(count)
+    mask_values = {mask: int(mask) for mask in set(masks)}
+    present = [mask_values[mask] for mask in masks]
+    values = [
+        hashes if name == "hash" else reader.read_column(count) for name in LOAD_FIELDS
+    ]
+    records = [
+        CwaRecord(row, mask)
+        for row, mask in zip(zip(*values, strict=True), present, strict=True)
+    ]
+    return records, unknown_tags
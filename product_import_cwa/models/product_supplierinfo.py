@@ -89,31 +89,89 @@ class ProductSupplierInfo(models.Model):
         related="product_tmpl_id.standard_price", string="Current Price"
     )
 
-    def compare_prices(self):
-        recs = self.search([("cwa", "=", True)])
+    def compare_prices(self, unique_ids=None):
+        """
+        Compare the prices of all CWA supplier infos with the CWA products of
+        the same unique_id, in a few statements: supplier infos whose price
+        differs take the new prices and get flagged, together with their
+        product. CWA products with a supplier info become 'imported', the
+        other imported ones go back to 'new'.
+        Pass unique_ids to only compare those, e.g. the ones an import
+        touched; without them the whole catalog is reconciled.
+        """
         cwa_obj = self.env["cwa.product"]
-        for this in recs:
-            cwa = cwa_obj.search([("unique_id", "=", this.unique_id)])
-            if cwa and this.price != cwa[0].inkoopprijs:
-                this.write(
-                    {
-                        "has_new_price": True,
-                        "price": cwa[0].inkoopprijs,
-                        "inkoopprijs": cwa[0].inkoopprijs,
-                        "consumentenprijs": cwa[0].consumentenprijs,
-                    }
+        self.flush_model()
+        cwa_obj.flush_model()
+        params = {
+            "everything": unique_ids is None,
+            "unique_ids": list(unique_ids or []),
+            "precision": self.env["decimal.precision"].precision_get("Product Price"),
+            "uid": self.env.uid,
+        }
+        # left behind when an earlier comparison of the transaction failed
+        self.env.cr.execute("DROP TABLE IF EXISTS cwa_compare_prices")
+        # the first active CWA product of every unique_id, as search() finds
+        self.env.cr.execute(
+            """
+            CREATE TEMP TABLE cwa_compare_prices ON COMMIT DROP AS
+            SELECT DISTINCT ON (unique_id) id, unique_id,
+                COALESCE(inkoopprijs, 0) AS inkoopprijs,
+                COALESCE(consumentenprijs, 0) AS consumentenprijs
+            FROM cwa_product
+            WHERE active AND unique_id IN (
+                SELECT unique_id FROM product_supplierinfo WHERE cwa
+            ) AND (%(everything)s OR unique_id = ANY(%(unique_ids)s::varchar[]))
+            ORDER BY unique_id, id
+            """,
+            params,
+        )
+        self.env.cr.execute(
+            """
+            UPDATE product_supplierinfo AS info
+            SET has_new_price = true,
+                price = round(cwa.inkoopprijs::numeric, %(precision)s),
+                inkoopprijs = cwa.inkoopprijs,
+                consumentenprijs = cwa.consumentenprijs,
+                write_uid = %(uid)s,
+                write_date = now() at time zone 'UTC'
+            FROM cwa_compare_prices AS cwa
+            WHERE info.cwa AND info.unique_id = cwa.unique_id
+                AND COALESCE(info.price, 0) != cwa.inkoopprijs
+            RETURNING info.id
+            """,
+            params,
+        )
+        changed = self.browse([row[0] for row in self.env.cr.fetchall()])
+        self.env.cr.execute(
+            """
+            UPDATE cwa_product AS product
+            SET state = CASE
+                    WHEN product.id IN (SELECT id FROM cwa_compare_prices)
+                    THEN 'imported' ELSE 'new' END,
+                write_uid = %(uid)s,
+                write_date = now() at time zone 'UTC'
+            WHERE product.active
+            AND (%(everything)s OR product.unique_id = ANY(%(unique_ids)s::varchar[]))
+            AND (
+                product.id IN (SELECT id FROM cwa_compare_prices)
+                AND product.state IS DISTINCT FROM 'imported'
+                OR product.state = 'imported' AND product.unique_id NOT IN (
+                    SELECT unique_id FROM cwa_compare_prices
                 )
-                this.product_tmpl_id.has_new_price = True
-            if cwa:
-                cwa[0].write({"state": "imported"})
-        cwa_all = cwa_obj.search([("state", "=", "imported")])
-        already_imported = cwa_obj.search(
-            [("unique_id", "in", recs.mapped("unique_id"))]
+            )
+            RETURNING product.id
+            """,
+            params,
         )
-        # Get ones with state imported but not in supplier info
-        not_imported = cwa_all - already_imported
-        for item in not_imported:
-            item.write({"state": "new"})
+        restated = cwa_obj.browse([row[0] for row in self.env.cr.fetchall()])
+        self.env.cr.execute("DROP TABLE cwa_compare_prices")
+
+        changed_fields = ["has_new_price", "price", "inkoopprijs", "consumentenprijs"]
+        self.invalidate_model([*changed_fields, "write_uid", "write_date"])
+        changed.modified(changed_fields)
+        cwa_obj.invalidate_model(["state", "write_uid", "write_date"])
+        restated.modified(["state"])
+        changed.product_tmpl_id.write({"has_new_price": True})
 
     def update_price(self):
         """Updates the price with new value"""
@@ -146,8 +204,9 @@ class ProductSupplierInfo(models.Model):
             this.product_tmpl_id.has_new_price = False
 
     def unlink(self):
-        for prod in self:
-            cwa = self.env["cwa.product"].search([("unique_id", "=", prod.unique_id)])
+        unique_ids = self.filtered("unique_id").mapped("unique_id")
+        if unique_ids:
+            cwa = self.env["cwa.product"].search([("unique_id", "in", unique_ids)])
             cwa.write(
                 {
                     "state": "new",
@@ -103,14 +103,12 @@ class ProductTemplate(models.Model):
                 this.preferred_supplier_id = this.seller_ids[0].id
 
     def unlink(self):
-        for prod in self:
-            for supplier_info in prod.seller_ids:
-                cwa = self.env["cwa.product"].search(
-                    [("unique_id", "=", supplier_info.unique_id)]
-                )
-                cwa.write(
-                    {
-                        "state": "new",
-                    }
-                )
+        unique_ids = self.seller_ids.filtered("unique_id").mapped("unique_id")
+        if unique_ids:
+            cwa = self.env["cwa.product"].search([("unique_id", "in", unique_ids)])
+            cwa.write(
+                {
+                    "state": "new",
+                }
+            )
         return super().unlink()
@@ -16,3 +16,33 @@ class ResConfigSettings(models.TransientModel):
     cwa_ftp_password = fields.Char(
         "Password", config_parameter="cwa_ftp_password", default=""
     )
+    cwa_archive_removed_products = fields.Boolean(
+        "Archive removed products",
+        config_parameter="cwa_archive_removed_products",
+        help="Archive CWA products that disappear from the feed instead of "
+        "deleting them, so they are revived cheaply when they come back.",
+    )
+    cwa_ftp_pipelined_import = fields.Boolean(
+        "Pipelined FTP import",
+        config_parameter="cwa_ftp_pipelined_import",
+        help="Parse the feed while it is being downloaded instead of saving it "
+        "to disk first.",
+    )
+    cwa_ftp_keep_feed_copy = fields.Boolean(
+        "Keep feed copy",
+        config_parameter="cwa_ftp_keep_feed_copy",
+        help="Also write the feed to the feed cache during a pipelined import, "
+        "for auditing.",
+    )
+    cwa_parse_workers = fields.Integer(
+        "Parse workers",
+        config_parameter="cwa_parse_workers",
+        help="Number of processes converting the products of a feed file. "
+        "Leave at 0 or 1 to parse in the Odoo worker itself.",
+    )
+    cwa_import_lock_wait = fields.Integer(
+        "Wait for running import",
+        config_parameter="cwa_import_lock_wait",
+        help="Seconds an import waits for another running import to finish. "
+        "Leave at 0 to skip the import instead.",
+    )
@@ -1,8 +1,25 @@
+import base64
+import datetime
 import hashlib
+import io
 import logging
 import math
+import mmap
+import multiprocessing
+import os
 import re
-
+import resource
+import struct
+import sys
+import time
+import zlib
+from collections import Counter
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import repeat
+
+import psycopg2
 from lxml import etree
 
 _logger = logging.getLogger(__name__)
@@ -18,6 +35,9 @@ YESNO_SELECTION = [("0", "ONBEKEND"), ("1", "JA"), ("2", "NEE")]
 
 BOOLEAN_KEYS = ("weegschaalartikel", "pluartikel", "wichtartikel")
 
+# Number of rows fetched at once when streaming the existing hashes
+HASH_FETCH_SIZE = 10000
+
 
 def ean_checksum(eancode):
     """
@@ -73,6 +93,26 @@ def split_data(data, split_size=50):
     return [data[x : x + split_size] for x in range(0, len(data), split_size)]
 
 
+def copy_text_value(value):
+    """Render a column value in the text format used by PostgreSQL COPY"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def parse_ftp_timestamp(value):
+    """Parse a MDTM / MLSD timestamp (YYYYMMDDHHMMSS[.sss], UTC)"""
+    return datetime.datetime.strptime(value[:14], "%Y%m%d%H%M%S")
+
+
 def set_external_id(data):
     if data["eancode"] == 0:
         return f"product_ex_id_{data['leveranciernummer']}_{data['bestelnummer']}"
@@ -153,21 +193,282 @@ FIELDS_TO_LOAD = (
     "leveranciernummer",
     (None, "unique_id"),
     (None, "hash"),
+    (None, "field_hashes"),
 )
 
+# Bump when the conversion or hashing of products changes, this
+# invalidates the feed snapshots written by earlier versions
+LOADER_VERSION = 1
+
+# Fields that identify a parsed record rather than describe the product
+RECORD_KEYS = ("unique_id", "hash", "field_hashes")
+
+# Destination fields in load order, i.e. the column order of loaded rows
+LOAD_FIELDS = tuple(
+    rec[1] if isinstance(rec, tuple) else rec
+    for rec in FIELDS_TO_LOAD
+    if not isinstance(rec, tuple) or rec[1]
+)
+LOAD_FIELD_INDEXES = {name: index for index, name in enumerate(LOAD_FIELDS)}
+# Fields with a digest in the field_hashes vector
+HASHED_FIELDS = tuple(name for name in LOAD_FIELDS if name not in RECORD_KEYS)
+
+# Fields with few distinct values, shared between products instead of
+# being stored once per product
+INTERNED_FIELDS = frozenset(
+    (
+        "eenheid",
+        "verpakkingce",
+        "merk",
+        "kwaliteit",
+        "btw",
+        "cblcode",
+        "herkomst",
+        "status",
+        "keurmerkbio",
+        "keurmerkoverig",
+        "herkomstregio",
+        "bewaartemperatuur",
+    )
+    + tuple(name for name in LOAD_FIELDS if re.fullmatch(r"d2\d\db?", name))
+)
+
+# Source tags the unique id of a product is made of
+UNIQUE_ID_TAGS = ("leveranciernummer", "bestelnummer")
+
+YESNO_VALUES = frozenset(key for key, _label in YESNO_SELECTION)
+
+# Returned by a converter when the tag should not be loaded at all
+SKIP_VALUE = object()
+
+
+def convert_price(value):
+    return f"{float(value):.2f}"
+
+
+def convert_packaging(value):
+    return value.upper() if value else SKIP_VALUE
+
+
+def convert_yesno(value):
+    return value if value in YESNO_VALUES else "0"
+
+
+def convert_boolean(value):
+    return "true" if value == "1" else "false"
+
+
+def convert_upper(value):
+    return value.upper()
+
+
+def convert_default(value):
+    return value.upper() if value else None
+
+
+SPECIAL_CONVERTERS = {
+    # load prices as floats
+    "consumentenprijs": convert_price,
+    "inkoopprijs": convert_price,
+    "verpakkingce": convert_packaging,
+    # load yes/no selections
+    "proefdiervrij": convert_yesno,
+    "vegetarisch": convert_yesno,
+    "veganistisch": convert_yesno,
+    "rauwemelk": convert_yesno,
+    # load booleans
+    "weegschaalartikel": convert_boolean,
+    "pluartikel": convert_boolean,
+    "wichtartikel": convert_boolean,
+    "omschrijving": convert_upper,
+}
+
+
+def compile_tag_converters(fields_to_load):
+    """Map every source tag to the function converting its value"""
+    converters = {}
+    for rec in fields_to_load:
+        tag = rec[0] if isinstance(rec, tuple) else rec
+        if tag:
+            converters[tag] = SPECIAL_CONVERTERS.get(tag, convert_default)
+    return converters
+
+
+TAG_CONVERTERS = compile_tag_converters(FIELDS_TO_LOAD)
+
+
+class CwaRecord(Mapping):
+    """
+    A parsed CWA product: its values in LOAD_FIELDS order and a bit mask of
+    the fields the feed provided. Reads like a dict of the provided fields,
+    at a fraction of the memory of one.
+    """
+
+    __slots__ = ("values", "present")
+
+    def __init__(self, values, present):
+        self.values = values
+        self.present = present
+
+    def __getitem__(self, key):
+        index = LOAD_FIELD_INDEXES[key]
+        if not self.present >> index & 1:
+            raise KeyError(key)
+        return self.values[index]
+
+    def get(self, key, default=None):
+        index = LOAD_FIELD_INDEXES.get(key)
+        if index is None or not self.present >> index & 1:
+            return default
+        return self.values[index]
+
+    def __iter__(self):
+        present = self.present
+        return (name for index, name in enumerate(LOAD_FIELDS) if present >> index & 1)
+
+    def __len__(self):
+        return bin(self.present).count("1")
+
+    def __repr__(self):
+        return f"CwaRecord({dict(self)!r})"
+
+
+# Start of a <product> element, not of a tag like <productnaam>
+PRODUCT_START = re.compile(rb"<product[\s/>]")
+
+# Byte ranges per worker, so a slow range does not hold up the others
+RANGES_PER_WORKER = 4
+
+
+def split_feed(prod_file, parts):
+    """
+    Split a feed file into at most `parts` byte ranges that each hold
+    complete <product> elements
+    """
+    if not os.path.getsize(prod_file):
+        return []
+    with open(prod_file, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        first = PRODUCT_START.search(data)
+        if not first:
+            return []
+        start = first.start()
+        # the closing tag of the root element
+        end = data.rfind(b"</")
+        boundaries = [start]
+        for part in range(1, parts):
+            match = PRODUCT_START.search(data, start + (end - start) * part // parts)
+            if match and boundaries[-1] < match.start() < end:
+                boundaries.append(match.start())
+        boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:], strict=True))
+
+
+def parse_feed_range(prod_file, start, end, encoding):
+    """
+    Convert and hash the products in a byte range of a feed. Runs in a
+    worker process, so it only depends on the feed file and returns the
+    parsed products and the unknown tags it met.
+    """
+    with open(prod_file, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+    document = (
+        f'<?xml version="1.0" encoding="{encoding}"?><xmlartikel>'.encode("ascii")
+        + data
+        + b"</xmlartikel>"
+    )
+    loader = XMLProductLoader(None)
+    events = etree.iterparse(
+        io.BytesIO(document), events=("end",), tag="product", recover=True
+    )
+    products = list(loader.parse_products(loader.release_products(events)))
+    return products, loader.unknown_tags
+
+
+def read_peak_rss():
+    """Peak RSS of the process in MB, since it was last reset"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and cannot be reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process to its current RSS, where Linux allows"""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+class PhaseRecorder:
+    """
+    Measure the phases of an import: wall time, SQL queries, rows touched
+    and the peak RSS of the process during the phase. A phase measured
+    inside another one is not counted again in the outer phase, but its
+    peak RSS counts for the outer phase as well.
+    """
+
+    def __init__(self, cr):
+        self.cr = cr
+        self.phases = []
+        # time, queries and peak RSS of the phases nested in the current one
+        self.nested = [0.0, 0, 0.0]
+
+    @contextmanager
+    def measure(self, name):
+        """Measure a phase; set "rows" on the yielded dict to the rows touched"""
+        phase = {"name": name, "rows": 0}
+        outer_nested, self.nested = self.nested, [0.0, 0, 0.0]
+        # the peak of the outer phase so far, before it is reset for this one
+        outer_nested[2] = max(outer_nested[2], read_peak_rss())
+        reset_peak_rss()
+        queries = self.cr.sql_log_count
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            duration = time.perf_counter() - start
+            query_count = self.cr.sql_log_count - queries
+            peak_rss = max(read_peak_rss(), self.nested[2])
+            outer_nested[0] += duration
+            outer_nested[1] += query_count
+            outer_nested[2] = max(outer_nested[2], peak_rss)
+            phase["duration"] = duration - self.nested[0]
+            phase["query_count"] = query_count - self.nested[1]
+            phase["peak_rss"] = peak_rss
+            self.nested = outer_nested
+            self.phases.append(phase)
+
 
 class XMLProductLoader:
     def __init__(self, cwa_product_model):
         self.cwa_product_model = cwa_product_model
 
-        self.cur_unique_ids = set()
         self.new_unique_ids = set()
+        self.archived_unique_ids = set()
+        # unique_id -> binary md5 digest of the stored record
         self.hash_dict = {}
+        # positions in update_records that only need their changed fields
+        self.changed_record_indexes = []
+        # unknown tag -> number of products it appeared in
+        self.unknown_tags = Counter()
 
         self.load_values = []
         self.update_records = []
-        self.load_fields = []
-        self.load_tags = []
+        self.pull_parser = None
+        # parsed records in feed order, only kept when set to a list
+        self.parsed_records = None
+        # measures the phases of the parse when set to a PhaseRecorder
+        self.phases = None
 
     @staticmethod
     def detect_encoding(xml_file):
@@ -179,148 +480,409 @@ class XMLProductLoader:
             return match.group(1)
         return "UTF-8"  # Default encoding if none is specified
 
-    def parse_from_xml(self, prod_file):
-        # make a dict with existing products by unique_id
-        self.fill_unique_ids_and_hash_dict()
+    @staticmethod
+    def release_products(events):
+        """
+        Hand out the parsed <product> elements one by one.
+        Every element is cleared after it has been handed out, together with
+        the siblings parsed before it, so memory use stays flat no matter
+        how big the feed is.
+        """
+        for _event, product in events:
+            yield product
+            product.clear()
+            while product.getprevious() is not None:
+                del product.getparent()[0]
+
+    @classmethod
+    def iter_products(cls, prod_file, encoding=None):
+        """Stream the <product> elements of a feed file"""
+        context = etree.iterparse(
+            prod_file,
+            events=("end",),
+            tag="product",
+            recover=True,
+            encoding=encoding,
+        )
+        yield from cls.release_products(context)
+        del context
 
-        # determine allowed source tags
-        # determine list of destination fields
-        self.determine_allowed_source_tags_and_destination_fields()
+    def parse_from_xml(self, prod_file):
+        self.prepare_parse()
 
         encoding = self.detect_encoding(prod_file)
-        parser = etree.XMLParser(recover=True, encoding=encoding)
 
         try:
-            root = etree.parse(prod_file, parser)
+            self.process_products(self.iter_products(prod_file, encoding=encoding))
         except etree.XMLSyntaxError:
             _logger.info("Error decoding. Retrying using recover mode...")
-            with open(prod_file, "rb") as file:
-                file_content = file.read()
-            parser = etree.XMLParser(recover=True)
-            root = etree.fromstring(file_content, parser)
+            self.reset_parsed_records()
+            self.process_products(self.iter_products(prod_file))
 
-        for product in root.iter("product"):
-            # copy full XML record to dict
-            temp_dict = self.copy_record_to_temp_dict(product)
+        return self.get_parse_results()
 
-            # decide which ones to load
-            load_dict = self.determine_tags_to_load(temp_dict)
+    def parse_from_xml_parallel(self, prod_file, workers):
+        """
+        Parse a feed with a pool of worker processes. Every worker converts
+        and hashes the products of a byte range of the file; the results are
+        compared with the existing records here, in feed order, so the
+        outcome is the same as that of parse_from_xml.
+        """
+        self.prepare_parse()
 
-            new_hash = self.create_hash_from_recs_to_load(load_dict)
+        encoding = self.detect_encoding(prod_file)
+        ranges = split_feed(prod_file, workers * RANGES_PER_WORKER)
+        try:
+            # the workers are forked: they need the addon modules, which a
+            # freshly started interpreter could not import
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                results = executor.map(
+                    parse_feed_range,
+                    repeat(prod_file),
+                    [start for start, _end in ranges],
+                    [end for _start, end in ranges],
+                    repeat(encoding),
+                )
+                for products, unknown_tags in results:
+                    self.unknown_tags.update(unknown_tags)
+                    for parsed_product in products:
+                        self.classify_product(*parsed_product)
+        except etree.XMLSyntaxError:
+            _logger.info("Error decoding. Retrying using recover mode...")
+            self.reset_parsed_records()
+            self.process_products(self.iter_products(prod_file))
 
-            load_dict["hash"] = new_hash
+        return self.get_parse_results()
 
-            # create the unique id for this record
-            unique_id = self.create_unique_id(temp_dict)
+    def parse_from_reader(self, prod_file, reader):
+        """Parse a feed with a reader yielding a tag -> value mapping per product"""
+        self.prepare_parse()
 
-            load_dict["unique_id"] = unique_id
-            self.new_unique_ids.add(unique_id)
+        self.process_products(
+            reader.iter_products(prod_file), convert=self.convert_mapping
+        )
 
-            self.determine_if_record_should_be_created_updated_or_ignored(
-                load_dict, new_hash, unique_id
-            )
+        return self.get_parse_results()
+
+    def parse_records(self, records):
+        """Compare already parsed records, e.g. from a feed snapshot"""
+        self.prepare_parse()
 
+        for record in records:
+            self.classify_product(record["unique_id"], record["hash"], record)
+
+        return self.get_parse_results()
+
+    def measure_phase(self, name):
+        if self.phases is None:
+            return nullcontext({})
+        return self.phases.measure(name)
+
+    def prepare_parse(self):
+        # make a dict with existing products by unique_id
+        with self.measure_phase("hash_load") as phase:
+            self.fill_unique_ids_and_hash_dict()
+            phase["rows"] = len(self.hash_dict)
+
+    def get_parse_results(self):
+        self.keep_changed_fields_of_updated_records()
+        self.log_unknown_tags()
         delete_records = self.calculate_records_that_should_be_deleted()
 
-        return self.load_fields, self.load_values, self.update_records, delete_records
+        return list(LOAD_FIELDS), self.load_values, self.update_records, delete_records
+
+    def start_incremental_parse(self):
+        """
+        Prepare to parse a feed that arrives in chunks, e.g. while it is
+        being downloaded. Feed the chunks to feed() and call
+        finish_incremental_parse() at the end.
+        """
+        self.prepare_parse()
+        # the encoding is taken from the XML declaration of the first chunk
+        self.pull_parser = etree.XMLPullParser(
+            events=("end",), tag="product", recover=True
+        )
+
+    def feed(self, data):
+        self.pull_parser.feed(data)
+        self.process_products(self.release_products(self.pull_parser.read_events()))
+
+    def finish_incremental_parse(self):
+        self.pull_parser.close()
+        self.process_products(self.release_products(self.pull_parser.read_events()))
+        self.pull_parser = None
+        return self.get_parse_results()
+
+    def process_products(self, products, convert=None):
+        for parsed_product in self.parse_products(products, convert=convert):
+            self.classify_product(*parsed_product)
+
+    def parse_products(self, products, convert=None):
+        """
+        Convert and hash products. Yields (unique_id, hash, record) without
+        looking at the existing records. Products are <product> elements
+        unless another convert function is given.
+        """
+        convert = convert or self.convert_product
+        hash_index = LOAD_FIELD_INDEXES["hash"]
+        field_hashes_index = LOAD_FIELD_INDEXES["field_hashes"]
+        unique_id_index = LOAD_FIELD_INDEXES["unique_id"]
+        record_keys_mask = sum(1 << LOAD_FIELD_INDEXES[key] for key in RECORD_KEYS)
+        for product in products:
+            # convert the XML record in one pass
+            id_values, values, present, feed_order = convert(product)
+
+            new_hash = self.create_hash_from_recs_to_load(
+                (LOAD_FIELDS[index], values[index]) for index in feed_order
+            )
+
+            values[hash_index] = new_hash
+            # create the unique id for this record
+            unique_id = self.create_unique_id(id_values)
+            values[unique_id_index] = unique_id
+            values[field_hashes_index] = self.create_field_hashes(
+                CwaRecord(values, present)
+            )
+            yield (
+                unique_id,
+                new_hash,
+                CwaRecord(tuple(values), present | record_keys_mask),
+            )
+
+    def classify_product(self, unique_id, new_hash, record):
+        if self.parsed_records is not None:
+            self.parsed_records.append(record)
+        self.new_unique_ids.add(unique_id)
+
+        self.determine_if_record_should_be_created_updated_or_ignored(
+            record, new_hash, unique_id
+        )
+
+    def reset_parsed_records(self):
+        if self.parsed_records is not None:
+            self.parsed_records = []
+        self.new_unique_ids = set()
+        self.load_values = []
+        self.update_records = []
+        self.changed_record_indexes = []
+        self.unknown_tags = Counter()
 
     def calculate_records_that_should_be_deleted(self):
-        earlier_imported_ids_not_present_in_current_data = list(
-            self.cur_unique_ids - self.new_unique_ids
+        earlier_imported_ids_not_present_in_current_data = (
+            self.hash_dict.keys() - self.new_unique_ids
         )
-        return earlier_imported_ids_not_present_in_current_data
+        # archived records are only left alone while removed products are
+        # archived, otherwise they are unlinked like the others
+        if self.cwa_product_model._archive_removed_products():
+            earlier_imported_ids_not_present_in_current_data -= self.archived_unique_ids
+        return list(earlier_imported_ids_not_present_in_current_data)
 
     def determine_if_record_should_be_created_updated_or_ignored(
         self, load_dict, new_hash, unique_id
     ):
-        old_hash = self.hash_dict.get(unique_id, None)
-        if old_hash:
-            # record exists, update only when hash is different
-            if old_hash != new_hash:
+        if unique_id in self.hash_dict:
+            old_hash = self.hash_dict[unique_id]
+            # archived record is back in the feed, revive it
+            if unique_id in self.archived_unique_ids:
                 load_dict = self.convert_booleans_in_load_dict(load_dict)
+                load_dict["active"] = True
+                self.update_records.append(load_dict)
+            # record exists, update only when hash is different or unknown
+            elif old_hash != bytes.fromhex(new_hash):
+                # the changed fields are picked once the feed is parsed
+                self.changed_record_indexes.append(len(self.update_records))
                 self.update_records.append(load_dict)
         else:
-            # convert load_dict to a list and append to load_values
-            load_list = [load_dict.get(name, None) for name in self.load_fields]
+            # convert load_dict to a row and append to load_values
+            if isinstance(load_dict, CwaRecord):
+                load_list = list(load_dict.values)
+            else:
+                load_list = [load_dict.get(name, None) for name in LOAD_FIELDS]
             self.load_values.append(load_list)
 
     def create_unique_id(self, temp_dict):
         return f"{temp_dict['leveranciernummer']}-{temp_dict['bestelnummer']}"
 
-    def create_hash_from_recs_to_load(self, load_dict):
-        # create a hash from the recs to load
+    def create_hash_from_recs_to_load(self, items):
+        # create a hash from the (field, value) pairs to load, in feed order
         _hash = hashlib.md5()
-        for key, value in load_dict.items():
+        for key, value in items:
             _hash.update(key.encode("utf-8"))
             _hash.update(str(value).encode("utf-8"))
         new_hash = _hash.hexdigest()
         return new_hash
 
-    def determine_tags_to_load(self, temp_dict):
-        load_dict = {}
-        for tag, value in temp_dict.items():
-            if tag not in self.load_tags:
-                _logger.warning("Ignoring unknown tag: %s", tag)
-                continue
-
-            # load prices as floats
-            elif tag in ("consumentenprijs", "inkoopprijs"):
-                load_dict[tag] = f"{float(value):.2f}"
-
-            elif tag == "verpakkingce":
-                if value:
-                    load_dict[tag] = value.upper()
-                # else:
-                #     load_dict[tag] = 'STUKS'
-
-            # load yes/no selections
-            elif tag in (
-                "proefdiervrij",
-                "vegetarisch",
-                "veganistisch",
-                "rauwemelk",
-            ):
-                if value in ["0", "1", "2"]:
-                    load_dict[tag] = value
-                else:
-                    load_dict[tag] = "0"
-
-            # load booleans
-            elif tag in BOOLEAN_KEYS:
-                if value == "1":
-                    load_dict[tag] = "true"
-                else:
-                    load_dict[tag] = "false"
-
-            elif tag == "omschrijving":
-                load_dict[tag] = value.upper()
+    def create_field_hashes(self, load_dict):
+        """
+        Create a compact vector with a CRC32 digest per loaded field,
+        preceded by a digest of the field names, so a later feed can tell
+        which columns changed.
+        """
+        digests = [zlib.crc32(",".join(HASHED_FIELDS).encode("utf-8"))]
+        for name in HASHED_FIELDS:
+            digests.append(zlib.crc32(str(load_dict.get(name)).encode("utf-8")))
+        packed = struct.pack(f"<{len(digests)}I", *digests)
+        return base64.b64encode(packed).decode("ascii")
+
+    def get_changed_fields(self, old_field_hashes, new_field_hashes):
+        """
+        Return the fields whose digest differs between both vectors, or None
+        when the vectors cannot be compared. No field differs when only the
+        order of the tags changed, the record then just gets its new hash.
+        """
+        if not old_field_hashes or len(old_field_hashes) != len(new_field_hashes):
+            return None
+        old_digests = base64.b64decode(old_field_hashes)
+        new_digests = base64.b64decode(new_field_hashes)
+        # the first digest covers the field names
+        if old_digests[:4] != new_digests[:4]:
+            return None
+        changed_fields = [
+            name
+            for index, name in enumerate(HASHED_FIELDS, start=1)
+            if old_digests[index * 4 : index * 4 + 4]
+            != new_digests[index * 4 : index * 4 + 4]
+        ]
+        return changed_fields
+
+    def keep_changed_fields_of_updated_records(self):
+        """
+        Reduce the changed records to the fields that actually changed. The
+        stored digest vectors are only read for these records, in one query.
+        """
+        if not self.changed_record_indexes:
+            return
+        old_field_hashes = self.fetch_field_hashes(
+            [
+                self.update_records[index]["unique_id"]
+                for index in self.changed_record_indexes
+            ]
+        )
+        for index in self.changed_record_indexes:
+            load_dict = self.update_records[index]
+            load_dict = self.keep_changed_fields(
+                load_dict, old_field_hashes.get(load_dict["unique_id"])
+            )
+            self.update_records[index] = self.convert_booleans_in_load_dict(load_dict)
+        self.changed_record_indexes = []
+
+    def fetch_field_hashes(self, unique_ids):
+        cr = self.cwa_product_model.env.cr
+        cr.execute(
+            "SELECT unique_id, field_hashes FROM cwa_product WHERE unique_id = ANY(%s)",
+            (unique_ids,),
+        )
+        return dict(cr.fetchall())
 
-            else:
-                load_dict[tag] = value.upper() if value else None
-        return load_dict
-
-    def copy_record_to_temp_dict(self, product):
-        temp_dict = {}
-        for item in product:
-            temp_dict[item.tag] = item.text if item.text else None
-        return temp_dict
-
-    def determine_allowed_source_tags_and_destination_fields(self):
-        for rec in FIELDS_TO_LOAD:
-            if isinstance(rec, tuple):
-                if rec[0]:
-                    self.load_tags.append(rec[0])
-                if rec[1]:
-                    self.load_fields.append(rec[1])
-            else:
-                self.load_tags.append(rec)
-                self.load_fields.append(rec)
+    def keep_changed_fields(self, load_dict, old_field_hashes):
+        changed_fields = self.get_changed_fields(
+            old_field_hashes, load_dict["field_hashes"]
+        )
+        if changed_fields is None:
+            return load_dict
+        keep = set(changed_fields).union(RECORD_KEYS)
+        return {key: value for key, value in load_dict.items() if key in keep}
+
+    def convert_product(self, product):
+        """Convert a <product> element, see convert_items"""
+        return self.convert_items((item.tag, item.text) for item in product)
+
+    def convert_mapping(self, product):
+        """Convert a tag -> value mapping produced by a feed reader"""
+        return self.convert_items(product.items())
+
+    def convert_items(self, items):
+        """
+        Convert the (tag, value) pairs of a product in a single pass.
+        Returns the raw values making up the unique id, the converted values
+        ordered like LOAD_FIELDS, a bit mask of the fields present and the
+        indexes of these fields in feed order (the record hash depends on
+        that order).
+        """
+        id_values = {}
+        values = [None] * len(LOAD_FIELDS)
+        present = 0
+        feed_order = []
+        field_indexes = LOAD_FIELD_INDEXES
+        for tag, value in items:
+            value = value or None
+            if tag in UNIQUE_ID_TAGS:
+                id_values[tag] = value
+            converter = TAG_CONVERTERS.get(tag)
+            if converter is None:
+                self.count_unknown_tag(tag)
+                continue
+            value = converter(value)
+            if value is SKIP_VALUE:
+                continue
+            if value and tag in INTERNED_FIELDS:
+                value = sys.intern(value)
+            index = field_indexes[tag]
+            values[index] = value
+            if not present >> index & 1:
+                present |= 1 << index
+                feed_order.append(index)
+        return id_values, values, present, feed_order
+
+    def count_unknown_tag(self, tag):
+        # comments and processing instructions have no string tag
+        if isinstance(tag, str):
+            self.unknown_tags[tag] += 1
+
+    def log_unknown_tags(self):
+        if self.unknown_tags:
+            _logger.warning(
+                "Ignored unknown tags: %s",
+                ", ".join(
+                    f"{tag} ({count})" for tag, count in self.unknown_tags.most_common()
+                ),
+            )
 
     def fill_unique_ids_and_hash_dict(self):
-        records = self.cwa_product_model.search([]).read(["unique_id", "hash"])
-        for record in records:
-            self.cur_unique_ids.add(record["unique_id"])
-            self.hash_dict[record["unique_id"]] = record["hash"]
+        """
+        Stream unique_id, hash and active of the existing products through a
+        server side cursor, without building a recordset. Unique ids are
+        interned and hashes kept as binary digests to keep the map small.
+        """
+        self.cwa_product_model.flush_model(["unique_id", "hash", "active"])
+        cr = self.cwa_product_model.env.cr
+        cr.execute(
+            "DECLARE cwa_product_hashes NO SCROLL CURSOR FOR "
+            "SELECT unique_id, hash, active FROM cwa_product"
+        )
+        try:
+            self._fetch_unique_ids_and_hashes(cr)
+        except psycopg2.Error:
+            # the aborted transaction closes the cursor
+            raise
+        except Exception:
+            cr.execute("CLOSE cwa_product_hashes")
+            raise
+        cr.execute("CLOSE cwa_product_hashes")
+
+    def _fetch_unique_ids_and_hashes(self, cr):
+        while True:
+            cr.execute("FETCH FORWARD %s FROM cwa_product_hashes", (HASH_FETCH_SIZE,))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            for unique_id, _hash, active in rows:
+                if not unique_id:
+                    continue
+                unique_id = sys.intern(unique_id)
+                self.hash_dict[unique_id] = self.parse_stored_hash(_hash)
+                if not active:
+                    self.archived_unique_ids.add(unique_id)
+
+    @staticmethod
+    def parse_stored_hash(_hash):
+        """The binary digest of a stored hash, None when there is none to compare"""
+        try:
+            return bytes.fromhex(_hash)
+        except (TypeError, ValueError):
+            return None
 
     def convert_booleans_in_load_dict(self, load_dict):
         return_dict = {}
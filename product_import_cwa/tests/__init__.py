@@ -1,3 +1,8 @@
 # Copyright 2017 Therp BV <http://therp.nl>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 from . import test_product_import_cwa
+from . import test_ftp_fetch
+from . import test_feed_snapshot
+from . import test_feed_readers
+from . import test_import_benchmark
+from . import test_query_counts
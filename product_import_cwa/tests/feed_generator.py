@@ -0,0 +1,292 @@
+"""
+Generate CWA feeds of any size, e.g. to benchmark the import. The products
+look like the ones in the real feed and a feed only depends on its
+arguments, so the same feed can be generated again anywhere.
+
+A later generation of a feed has a share of its products changed and
+removed, and as many new products as were removed:
+
+    python feed_generator.py 100000 feed.xml
+    python feed_generator.py 100000 feed_next.xml --generation 1 \\
+        --change-ratio 0.05 --removal-ratio 0.01
+"""
+
+import argparse
+import datetime
+import math
+import random
+from itertools import accumulate
+from xml.sax.saxutils import escape
+
+ALLERGEN_TAGS = (
+    "d204",
+    "d209",
+    "d210",
+    "d212",
+    "d213",
+    "d214",
+    "d234",
+    "d215",
+    "d239",
+    "d216",
+    "d217",
+    "d217b",
+    "d220",
+    "d221",
+    "d221b",
+    "d222",
+    "d223",
+    "d236",
+    "d235",
+    "d238",
+    "d238b",
+    "d225",
+    "d226",
+    "d228",
+    "d230",
+    "d232",
+    "d237",
+    "d240",
+)
+YESNO_TAGS = ("proefdiervrij", "vegetarisch", "veganistisch", "rauwemelk")
+
+KNOWN_BRANDS = (
+    "Piramide",
+    "Lima",
+    "La Bioidea",
+    "NextBrush",
+    "Orthica",
+    "Allos",
+    "Carl Siegert",
+    "Ekoland",
+    "IDorganics",
+    "Zonnatura",
+)
+BRAND_COUNT = 400
+CBLCODE_COUNT = 300
+PRODUCT_WORDS = (
+    "Boekweit",
+    "Gierst",
+    "Havermout",
+    "Rijstwafels",
+    "Pindakaas",
+    "Appelsap",
+    "Tomatenpuree",
+    "Muesli",
+    "Sojadrink",
+    "Pasta",
+    "Linzen",
+    "Tandenborstel",
+    "Chocolade",
+    "Thee",
+    "Olijfolie",
+)
+PRODUCT_KINDS = ("naturel", "volkoren", "bio", "mild", "pittig", "fijn", "grof")
+# value -> weight, after the frequencies in products_test.xml
+ALLERGEN_VALUES = {"0": 59, "3": 21, "2": 18, "1": 2}
+YESNO_VALUES = {"0": 80, "1": 15, "2": 5}
+UNITS = {"Gram": 50, "stuk": 36, "kg": 6, "Ml": 5, "Liter": 3}
+QUALITIES = {"Biologisch": 70, "": 30}
+ORIGINS = {"NL": 26, "": 22, "EU/niet-EU": 15, "IT": 14, "DE": 8, "BE": 5, "JP": 5}
+VAT_RATES = {"6": 88, "21": 12}
+SUPPLIERS = {"1002": 69, "1001": 26, "1007": 3, "1040": 2}
+STATUSES = {"Actief": 92, "Non actief": 8}
+PACKAGING_UNITS = {"6": 46, "1": 23, "10": 8, "12": 8, "30": 5, "20": 5, "9": 5}
+CONTENTS = {"20": 22, "1": 14, "125": 11, "400": 9, "250": 9, "500": 9, "1000": 6}
+FIRST_DATE = datetime.date(2015, 1, 1)
+
+
+def zipf_weights(count):
+    """Weights of a few very common values followed by a long tail"""
+    return [1 / rank for rank in range(1, count + 1)]
+
+
+BRANDS = KNOWN_BRANDS + tuple(
+    f"Merk {number:03d}" for number in range(len(KNOWN_BRANDS), BRAND_COUNT)
+)
+CBLCODES = tuple(
+    str(1010000 + (number * 7919) % 1900000) for number in range(CBLCODE_COUNT)
+)
+
+
+class Choice:
+    """Pick weighted values quickly, with the cumulative weights computed once"""
+
+    def __init__(self, values, weights=None):
+        if isinstance(values, dict):
+            values, weights = list(values), list(values.values())
+        self.values = values
+        self.cum_weights = list(accumulate(weights))
+
+    def __call__(self, rng):
+        return rng.choices(self.values, cum_weights=self.cum_weights)[0]
+
+
+BRAND = Choice(BRANDS, zipf_weights(BRAND_COUNT))
+CBLCODE = Choice(CBLCODES, zipf_weights(CBLCODE_COUNT))
+ALLERGEN = Choice(ALLERGEN_VALUES)
+YESNO = Choice(YESNO_VALUES)
+UNIT = Choice(UNITS)
+QUALITY = Choice(QUALITIES)
+ORIGIN = Choice(ORIGINS)
+VAT_RATE = Choice(VAT_RATES)
+SUPPLIER = Choice(SUPPLIERS)
+STATUS = Choice(STATUSES)
+PACKAGING_UNIT = Choice(PACKAGING_UNITS)
+CONTENT = Choice(CONTENTS)
+
+
+def ean13(rng):
+    digits = "87" + "".join(str(rng.randrange(10)) for _i in range(10))
+    total = sum(int(digit) * (3 if i % 2 else 1) for i, digit in enumerate(digits))
+    return digits + str((10 - total % 10) % 10)
+
+
+def format_price(price):
+    return f"{price:.2f}".rstrip("0").rstrip(".")
+
+
+def generate_product(seed, index):
+    """Return the tag -> value items of product number index"""
+    rng = random.Random(f"{seed}-{index}")
+    # purchase prices are log-normally spread around 2.50
+    purchase_price = max(0.05, round(rng.lognormvariate(math.log(2.5), 0.8), 2))
+    retail_price = round(purchase_price * rng.uniform(1.45, 1.75), 2)
+    weighed = rng.random() < 0.08
+    product = [
+        ("eancode", "" if rng.random() < 0.1 else ean13(rng)),
+        (
+            "omschrijving",
+            f"{rng.choice(PRODUCT_WORDS)} {rng.choice(PRODUCT_KINDS)} {index}",
+        ),
+        ("weegschaalartikel", "1" if weighed and rng.random() < 0.5 else "0"),
+        ("wichtartikel", "1" if weighed else "0"),
+        ("pluartikel", "0"),
+        ("inhoud", CONTENT(rng)),
+        ("eenheid", UNIT(rng)),
+        ("verpakkingce", ""),
+        ("merk", BRAND(rng)),
+        ("kwaliteit", QUALITY(rng)),
+        ("herkomst", ORIGIN(rng)),
+        ("btw", VAT_RATE(rng)),
+        ("cblcode", CBLCODE(rng)),
+        ("leveranciernummer", SUPPLIER(rng)),
+        ("bestelnummer", str(100000 + index)),
+        ("sve", PACKAGING_UNIT(rng)),
+        ("status", STATUS(rng)),
+    ]
+    if rng.random() < 0.75:
+        product.append(("ingredienten", f"Ingredienten: {product[1][1].lower()}"))
+    product += [(tag, ALLERGEN(rng)) for tag in ALLERGEN_TAGS]
+    product += [(tag, YESNO(rng)) for tag in YESNO_TAGS]
+    product += [
+        ("inkoopprijs", format_price(purchase_price)),
+        ("consumentenprijs", format_price(retail_price)),
+        (
+            "ingangsdatum",
+            (FIRST_DATE + datetime.timedelta(days=rng.randrange(3650))).isoformat(),
+        ),
+    ]
+    return product
+
+
+def change_product(product, rng):
+    """Change what usually changes between two feeds: prices, now and then more"""
+    product = dict(product)
+    factor = rng.uniform(0.9, 1.15)
+    for tag in ("inkoopprijs", "consumentenprijs"):
+        product[tag] = format_price(max(0.05, float(product[tag]) * factor))
+    if rng.random() < 0.2:
+        product["status"] = "Non actief" if product["status"] == "Actief" else "Actief"
+    if rng.random() < 0.1:
+        product[rng.choice(ALLERGEN_TAGS)] = ALLERGEN(rng)
+    return list(product.items())
+
+
+def iter_feed_products(
+    count, seed=0, generation=0, change_ratio=0.05, removal_ratio=0.01
+):
+    """
+    Yield the products of a feed. Every generation changes and removes a
+    share of the products of the one before, and adds new products.
+    """
+    indexes = range(count)
+    changes = {}
+    next_index = count
+    for number in range(1, generation + 1):
+        rng = random.Random(f"{seed}-generation-{number}")
+        kept = []
+        for index in indexes:
+            roll = rng.random()
+            if roll < removal_ratio:
+                continue
+            if roll < removal_ratio + change_ratio:
+                changes[index] = changes.get(index, 0) + 1
+            kept.append(index)
+        added = count - len(kept)
+        indexes = kept + list(range(next_index, next_index + added))
+        next_index += added
+    for index in indexes:
+        product = generate_product(seed, index)
+        for change in range(changes.get(index, 0)):
+            product = change_product(
+                product, random.Random(f"{seed}-{index}-change-{change}")
+            )
+        yield product
+
+
+def write_feed(path, products):
+    """Write products as a feed file laid out like the real feed"""
+    with open(path, "w", encoding="ISO-8859-1", errors="replace") as feed:
+        feed.write('<?xml version="1.0" encoding="ISO-8859-1" ?>\n<xmlartikel>\n')
+        for product in products:
+            feed.write("  <product>\n")
+            for tag, value in product:
+                if value:
+                    feed.write(f"  <{tag}>{escape(value)}</{tag}>\n")
+                else:
+                    feed.write(f"  <{tag} />\n")
+            feed.write("  </product>\n")
+        feed.write("</xmlartikel>\n")
+
+
+def generate_feed(path, count, **kwargs):
+    write_feed(path, iter_feed_products(count, **kwargs))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic CWA feed")
+    parser.add_argument("count", type=int, help="number of products")
+    parser.add_argument("path", help="feed file to write")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--generation",
+        type=int,
+        default=0,
+        help="number of feeds since the first one, to get a later feed",
+    )
+    parser.add_argument(
+        "--change-ratio",
+        type=float,
+        default=0.05,
+        help="share of the products changed by every generation",
+    )
+    parser.add_argument(
+        "--removal-ratio",
+        type=float,
+        default=0.01,
+        help="share of the products removed by every generation",
+    )
+    args = parser.parse_args(args)
+    generate_feed(
+        args.path,
+        args.count,
+        seed=args.seed,
+        generation=args.generation,
+        change_ratio=args.change_ratio,
+        removal_ratio=args.removal_ratio,
+    )
+
+
+if __name__ == "__main__":
+    main()
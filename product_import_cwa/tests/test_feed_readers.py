@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.product_import_cwa.models.feed_readers import (
+    CSVFeedReader,
+    JSONLinesFeedReader,
+    XMLFeedReader,
+    get_feed_reader,
+)
+from odoo.addons.product_import_cwa.models.utils import XMLProductLoader
+
+
+class TestFeedReaders(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        self.env["cwa.product"].search([]).unlink()
+        self.data_dir = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "data"
+        )
+
+    def parse(self, name, reader):
+        loader = XMLProductLoader(self.env["cwa.product"])
+        loader.parsed_records = []
+        parsed = loader.parse_from_reader(os.path.join(self.data_dir, name), reader)
+        return parsed, loader.parsed_records
+
+    def test_reader_is_picked_by_extension(self):
+        for name, reader in (
+            ("products_test.xml", XMLFeedReader),
+            ("products_test.csv", CSVFeedReader),
+            ("products_test.jsonl", JSONLinesFeedReader),
+        ):
+            self.assertIs(get_feed_reader(os.path.join(self.data_dir, name)), reader)
+
+    def test_reader_is_picked_by_content(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name, reader in (
+            ("products_test.xml", XMLFeedReader),
+            ("products_test.csv", CSVFeedReader),
+            ("products_test.jsonl", JSONLinesFeedReader),
+        ):
+            prod_file = os.path.join(directory, name.replace(".", "_"))
+            shutil.copy(os.path.join(self.data_dir, name), prod_file)
+            self.assertIs(get_feed_reader(prod_file), reader)
+
+    def test_xml_reader_matches_xml_parser(self):
+        loader = XMLProductLoader(self.env["cwa.product"])
+        parsed = loader.parse_from_xml(os.path.join(self.data_dir, "products_test.xml"))
+        self.assertEqual(self.parse("products_test.xml", XMLFeedReader)[0], parsed)
+
+    def test_json_lines_feed_matches_xml_feed(self):
+        xml_parsed = self.parse("products_test.xml", XMLFeedReader)[0]
+        self.assertEqual(
+            self.parse("products_test.jsonl", JSONLinesFeedReader)[0], xml_parsed
+        )
+
+    def test_csv_feed_has_the_values_of_the_xml_feed(self):
+        # CSV cannot tell an empty tag from a missing one, so only the values
+        # are compared and not the hashes
+        def values(records):
+            return [
+                {
+                    name: value
+                    for name, value in record.items()
+                    if value is not None and name not in ("hash", "field_hashes")
+                }
+                for record in records
+            ]
+
+        xml_records = self.parse("products_test.xml", XMLFeedReader)[1]
+        csv_records = self.parse("products_test.csv", CSVFeedReader)[1]
+        self.assertEqual(values(csv_records), values(xml_records))
+
+    def test_import_csv_feed(self):
+        count = (
+            self.env["cwa.product"]
+            .with_context(new_cursor=False)
+            .import_xml_products(os.path.join(self.data_dir, "products_test.csv"))
+        )
+        self.assertEqual(count, 65)
+        product = self.env["cwa.product"].search([("omschrijving", "=", "BOEKWEIT")])
+        self.assertEqual(len(product), 1)
+
+    def write_feed(self, name, content):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        prod_file = os.path.join(directory, name)
+        with open(prod_file, "w", encoding="utf-8") as file:
+            file.write(content)
+        return prod_file
+
+    def test_json_lines_booleans_read_like_xml(self):
+        prod_file = self.write_feed(
+            "products.jsonl",
+            '{"bestelnummer": 1, "wichtartikel": true, "pluartikel": false}\n',
+        )
+        self.assertEqual(
+            list(JSONLinesFeedReader.iter_products(prod_file)),
+            [{"bestelnummer": "1", "wichtartikel": "1", "pluartikel": "0"}],
+        )
+
+    def test_csv_reader_reads_a_single_column(self):
+        prod_file = self.write_feed("products.csv", "bestelnummer\n1001\n1002\n")
+        self.assertEqual(
+            list(CSVFeedReader.iter_products(prod_file)),
+            [{"bestelnummer": "1001"}, {"bestelnummer": "1002"}],
+        )
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from odoo import tools
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.product_import_cwa.models import feed_snapshot
+from odoo.addons.product_import_cwa.models.utils import XMLProductLoader
+
+
+class TestFeedSnapshot(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        path = os.path.dirname(os.path.realpath(__file__))
+        self.prod_file = os.path.join(self.cache_dir, "Artikelen.xml")
+        shutil.copy(os.path.join(path, "data/products_test.xml"), self.prod_file)
+        self.snapshot_path = feed_snapshot.get_snapshot_path(self.prod_file)
+
+    def parse_with_snapshot(self):
+        loader = XMLProductLoader(self.env["cwa.product"])
+        loader.parsed_records = []
+        parsed = loader.parse_from_xml(self.prod_file)
+        feed_snapshot.write_snapshot(
+            self.snapshot_path, loader.parsed_records, loader.unknown_tags
+        )
+        return loader.parsed_records, parsed
+
+    def test_snapshot_round_trip(self):
+        records, parsed = self.parse_with_snapshot()
+        snapshot_records, unknown_tags = feed_snapshot.read_snapshot(self.snapshot_path)
+        self.assertEqual(unknown_tags, {})
+        self.assertEqual(
+            [dict(record) for record in snapshot_records],
+            [dict(record) for record in records],
+        )
+        loader = XMLProductLoader(self.env["cwa.product"])
+        self.assertEqual(loader.parse_records(snapshot_records), parsed)
+
+    def test_snapshot_is_ignored_when_fields_change(self):
+        self.parse_with_snapshot()
+        with patch.object(feed_snapshot, "SNAPSHOT_SIGNATURE", b"\0" * 32):
+            self.assertIsNone(feed_snapshot.read_snapshot(self.snapshot_path))
+
+    def test_truncated_snapshot_is_ignored(self):
+        self.parse_with_snapshot()
+        with open(self.snapshot_path, "r+b") as file:
+            file.truncate(os.path.getsize(self.snapshot_path) // 2)
+        self.assertIsNone(feed_snapshot.read_snapshot(self.snapshot_path))
+
+    def test_reimport_of_downloaded_feed_skips_parsing(self):
+        cwa_product_obj = self.env["cwa.product"].with_context(new_cursor=False)
+        with patch.dict(tools.config.options, {"cwa_feed_cache_dir": self.cache_dir}):
+            cwa_product_obj.import_xml_products(self.prod_file)
+            self.assertTrue(os.path.exists(self.snapshot_path))
+            cwa_product_obj.search([("unique_id", "=", "1007-1001")]).unlink()
+            with patch.object(
+                XMLProductLoader, "iter_products", side_effect=AssertionError
+            ):
+                recount = cwa_product_obj.import_xml_products(
+                    self.prod_file, force=True
+                )
+        self.assertEqual(recount, 1)
@@ -0,0 +1,249 @@
+import datetime
+import fcntl
+import ftplib
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from odoo import tools
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.product_import_cwa.models import cwa_import_run
+
+FEED_NAME = "Artikelen_20240301.xml"
+FEED_MTIME = datetime.datetime(2024, 3, 1, 6, 30, 0)
+
+
+class FakeFTPServer:
+    """In-process stand-in for an FTP server exposing a 'VoorWinkel' directory"""
+
+    def __init__(self, files, mlsd=True, facts=True):
+        self.files = files
+        self.mlsd_supported = mlsd
+        # whether SIZE and MDTM are supported
+        self.facts_supported = facts
+        self.retrieved = []
+        # number of bytes after which transfers stop early, if any
+        self.transfer_limit = None
+
+    def connect(self, host, user, passwd, timeout=None):
+        return FakeFTPConnection(self)
+
+
+class FakeFTPConnection:
+    def __init__(self, server):
+        self.server = server
+        self.encoding = "latin-1"
+
+    def cwd(self, directory):
+        if directory != "VoorWinkel":
+            raise ftplib.error_perm("550 No such directory")
+
+    def nlst(self):
+        return list(self.server.files)
+
+    def mlsd(self, path="", facts=None):
+        if not self.server.mlsd_supported:
+            raise ftplib.error_perm("500 Unknown command MLSD")
+        yield ".", {"type": "cdir"}
+        for name, (content, mtime) in self.server.files.items():
+            yield (
+                name,
+                {
+                    "type": "file",
+                    "size": str(len(content)),
+                    "modify": mtime.strftime("%Y%m%d%H%M%S"),
+                },
+            )
+
+    def voidcmd(self, cmd):
+        if cmd.startswith("MDTM "):
+            if not self.server.facts_supported:
+                raise ftplib.error_perm("500 Unknown command MDTM")
+            _content, mtime = self.server.files[cmd[5:]]
+            return "213 " + mtime.strftime("%Y%m%d%H%M%S")
+        return "200 OK"
+
+    def size(self, name):
+        if not self.server.facts_supported:
+            raise ftplib.error_perm("500 Unknown command SIZE")
+        return len(self.server.files[name][0])
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        name = os.path.basename(cmd.split(" ", 1)[1])
+        content = self.server.files[name][0][rest or 0 : self.server.transfer_limit]
+        self.server.retrieved.append((name, rest))
+        for position in range(0, len(content), blocksize):
+            callback(content[position : position + blocksize])
+        return "226 Transfer complete"
+
+    def quit(self):
+        return "221 Goodbye"
+
+
+class TestFtpFetch(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        ir_config = self.env["ir.config_parameter"].sudo()
+        ir_config.set_param("cwa_enable_ftp_import", True)
+        ir_config.set_param("cwa_ftp_address", "ftp.example.com")
+        ir_config.set_param("cwa_ftp_username", "user")
+        ir_config.set_param("cwa_ftp_password", "secret")
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.content = b"<xmlartikel>" + b"<product />" * 5000 + b"</xmlartikel>"
+        path = os.path.dirname(os.path.realpath(__file__))
+        self.feed_path = os.path.join(path, "data/products_test.xml")
+        with open(self.feed_path, "rb") as file:
+            self.feed_content = file.read()
+
+    def fetch(self, server):
+        with patch.object(ftplib, "FTP", server.connect), patch.dict(
+            tools.config.options, {"cwa_feed_cache_dir": self.cache_dir}
+        ):
+            return self.env["cwa.product"]._get_prod_file_from_ftp()
+
+    def test_feed_is_downloaded_once(self):
+        server = FakeFTPServer({FEED_NAME: (self.content, FEED_MTIME)})
+        local = self.fetch(server)
+        with open(local, "rb") as file:
+            self.assertEqual(file.read(), self.content)
+        self.assertEqual(
+            datetime.datetime.utcfromtimestamp(os.path.getmtime(local)), FEED_MTIME
+        )
+
+        self.assertEqual(self.fetch(server), local)
+        self.assertEqual(server.retrieved, [(FEED_NAME, None)])
+
+    def test_changed_feed_is_downloaded_again(self):
+        server = FakeFTPServer({FEED_NAME: (self.content, FEED_MTIME)})
+        first = self.fetch(server)
+        server.files[FEED_NAME] = (self.content + b" ", FEED_MTIME)
+        second = self.fetch(server)
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(server.retrieved), 2)
+
+    def test_interrupted_download_is_resumed(self):
+        server = FakeFTPServer({FEED_NAME: (self.content, FEED_MTIME)})
+        with patch.dict(tools.config.options, {"cwa_feed_cache_dir": self.cache_dir}):
+            local = self.env["cwa.product"]._get_cached_feed_path(
+                FEED_NAME, len(self.content), FEED_MTIME
+            )
+        with open(local + ".part", "wb") as file:
+            file.write(self.content[:1000])
+
+        self.assertEqual(self.fetch(server), local)
+        self.assertEqual(server.retrieved, [(FEED_NAME, 1000)])
+        with open(local, "rb") as file:
+            self.assertEqual(file.read(), self.content)
+
+    def test_incomplete_download_is_not_resumed(self):
+        server = FakeFTPServer({FEED_NAME: (self.content, FEED_MTIME)})
+        server.transfer_limit = 1000
+        self.assertFalse(self.fetch(server))
+        self.assertFalse(os.listdir(self.cache_dir))
+
+        server.transfer_limit = None
+        local = self.fetch(server)
+        self.assertEqual(server.retrieved, [(FEED_NAME, None), (FEED_NAME, None)])
+        with open(local, "rb") as file:
+            self.assertEqual(file.read(), self.content)
+
+    def test_download_in_progress_is_left_alone(self):
+        server = FakeFTPServer({FEED_NAME: (self.content, FEED_MTIME)})
+        with patch.dict(tools.config.options, {"cwa_feed_cache_dir": self.cache_dir}):
+            local = self.env["cwa.product"]._get_cached_feed_path(
+                FEED_NAME, len(self.content), FEED_MTIME
+            )
+        # another process is downloading the feed
+        with open(local + ".part", "wb") as file:
+            file.write(self.content[:1000])
+            file.flush()
+            fcntl.flock(file, fcntl.LOCK_EX)
+            self.assertFalse(self.fetch(server))
+        self.assertFalse(server.retrieved)
+        self.assertEqual(os.path.getsize(local + ".part"), 1000)
+
+    def test_size_and_mtime_without_mlsd(self):
+        server = FakeFTPServer({FEED_NAME: (self.content, FEED_MTIME)}, mlsd=False)
+        local = self.fetch(server)
+        self.assertTrue(local.endswith(f"-{len(self.content)}-20240301063000.xml"))
+
+    def test_feed_without_size_and_mtime(self):
+        server = FakeFTPServer(
+            {FEED_NAME: (self.content, FEED_MTIME)}, mlsd=False, facts=False
+        )
+        local = self.fetch(server)
+        self.addCleanup(os.remove, local)
+        with open(local, "rb") as file:
+            self.assertEqual(file.read(), self.content)
+        # the feed cannot be told unchanged, it is downloaded every time
+        self.assertEqual(self.fetch(server), local)
+        self.assertEqual(server.retrieved, [(FEED_NAME, None), (FEED_NAME, None)])
+        self.assertFalse(os.listdir(self.cache_dir))
+
+    def test_pipelined_import(self):
+        server = FakeFTPServer({FEED_NAME: (self.feed_content, FEED_MTIME)})
+        _keys, to_load, to_update, to_delete = self.env["cwa.product"].parse_from_xml(
+            self.feed_path
+        )
+        ir_config = self.env["ir.config_parameter"].sudo()
+        ir_config.set_param("cwa_ftp_pipelined_import", True)
+        with patch.object(ftplib, "FTP", server.connect), patch.dict(
+            tools.config.options, {"cwa_feed_cache_dir": self.cache_dir}
+        ):
+            count = self.env["cwa.product"].import_xml_products(False)
+        self.assertEqual(count, len(to_load) + len(to_update) + len(to_delete))
+        run = self.env["cwa.import.run"].search([], limit=1)
+        self.assertEqual(run.name, FEED_NAME)
+        self.assertEqual(run.file_size, len(self.feed_content))
+        self.assertEqual(run.remote_mtime, FEED_MTIME)
+        # no copy is kept unless asked for
+        self.assertFalse(os.listdir(self.cache_dir))
+
+    def test_pipelined_import_skips_unchanged_feed_before_download(self):
+        server = FakeFTPServer({FEED_NAME: (self.feed_content, FEED_MTIME)})
+        ir_config = self.env["ir.config_parameter"].sudo()
+        ir_config.set_param("cwa_ftp_pipelined_import", True)
+        with patch.object(ftplib, "FTP", server.connect), patch.dict(
+            tools.config.options, {"cwa_feed_cache_dir": self.cache_dir}
+        ):
+            self.env["cwa.product"].import_xml_products(False)
+            count = self.env["cwa.product"].import_xml_products(False)
+        self.assertEqual(count, 0)
+        self.assertEqual(server.retrieved, [(FEED_NAME, None)])
+        run = self.env["cwa.import.run"].search([], limit=1)
+        self.assertEqual(run.state, "skipped")
+        self.assertEqual(run.name, FEED_NAME)
+
+    def test_pipelined_import_locks_before_parsing(self):
+        server = FakeFTPServer({FEED_NAME: (self.feed_content, FEED_MTIME)})
+        ir_config = self.env["ir.config_parameter"].sudo()
+        ir_config.set_param("cwa_ftp_pipelined_import", True)
+        with patch.object(ftplib, "FTP", server.connect), patch.dict(
+            tools.config.options, {"cwa_feed_cache_dir": self.cache_dir}
+        ), self.registry.cursor() as other_cr:
+            other_cr.execute(
+                "SELECT pg_advisory_xact_lock(%s)", (cwa_import_run.IMPORT_LOCK_KEY,)
+            )
+            count = self.env["cwa.product"].import_xml_products(False)
+        self.assertEqual(count, 0)
+        # the existing products were not read, nor the feed downloaded
+        self.assertFalse(server.retrieved)
+        self.assertFalse(self.env["cwa.import.run"].search([]))
+
+    def test_pipelined_import_keeps_copy(self):
+        server = FakeFTPServer({FEED_NAME: (self.feed_content, FEED_MTIME)})
+        ir_config = self.env["ir.config_parameter"].sudo()
+        ir_config.set_param("cwa_ftp_pipelined_import", True)
+        ir_config.set_param("cwa_ftp_keep_feed_copy", True)
+        with patch.object(ftplib, "FTP", server.connect), patch.dict(
+            tools.config.options, {"cwa_feed_cache_dir": self.cache_dir}
+        ):
+            self.env["cwa.product"].import_xml_products(False)
+            local = self.env["cwa.product"]._get_cached_feed_path(
+                FEED_NAME, len(self.feed_content), FEED_MTIME
+            )
+        with open(local, "rb") as file:
+            self.assertEqual(file.read(), self.feed_content)
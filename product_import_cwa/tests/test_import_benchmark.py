@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.product_import_cwa.models.utils import PhaseRecorder, XMLProductLoader
+
+from . import feed_generator
+
+_logger = logging.getLogger(__name__)
+
+# Products per benchmarked feed, e.g. CWA_BENCHMARK_SIZES=10000,100000,500000
+BENCHMARK_SIZES = os.environ.get("CWA_BENCHMARK_SIZES", "10000")
+# File the results are written to as JSON, they are logged as well
+BENCHMARK_OUTPUT = os.environ.get("CWA_BENCHMARK_OUTPUT")
+# Share of the products that have a supplier info for compare_prices
+SUPPLIERINFO_RATIO = 0.1
+
+
+class TestFeedGenerator(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def generate(self, name, count, **kwargs):
+        path = os.path.join(self.directory, name)
+        feed_generator.generate_feed(path, count, **kwargs)
+        return path
+
+    def test_feed_generator_is_deterministic(self):
+        first = self.generate("first.xml", 50, seed=3)
+        second = self.generate("second.xml", 50, seed=3)
+        with open(first, "rb") as file1, open(second, "rb") as file2:
+            self.assertEqual(file1.read(), file2.read())
+
+    def test_feed_generator_changes_and_removes_products(self):
+        first = self.generate("first.xml", 200)
+        later = self.generate(
+            "later.xml", 200, generation=1, change_ratio=0.2, removal_ratio=0.1
+        )
+        loader = XMLProductLoader(self.env["cwa.product"])
+        keys, to_load, _to_update, _to_delete = loader.parse_from_xml(first)
+        self.assertEqual(len(to_load), 200)
+        self.env["cwa.product"].bulk_load_records(keys, to_load, "cwa.product")
+
+        loader = XMLProductLoader(self.env["cwa.product"])
+        _keys, to_load, to_update, to_delete = loader.parse_from_xml(later)
+        self.assertEqual(len(loader.new_unique_ids), 200)
+        self.assertEqual(len(to_load), len(to_delete))
+        self.assertTrue(0 < len(to_delete) < 40)
+        self.assertTrue(20 < len(to_update) < 60)
+
+
+@tagged("-standard", "cwa_benchmark")
+class TestImportBenchmark(TransactionCase):
+    """
+    Time the import steps on generated feeds. Not part of the standard
+    tests, run it with --test-tags cwa_benchmark.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cwa_product_obj = self.env["cwa.product"]
+
+    def create_supplierinfo(self, keys, to_load):
+        template = self.env["product.template"].create({"name": "CWA benchmark"})
+        partner = self.env["res.partner"].create({"name": "CWA benchmark"})
+        unique_id_index = keys.index("unique_id")
+        step = round(1 / SUPPLIERINFO_RATIO)
+        self.env["product.supplierinfo"].create(
+            [
+                {
+                    "partner_id": partner.id,
+                    "product_tmpl_id": template.id,
+                    "cwa": True,
+                    "unique_id": values[unique_id_index],
+                    "price": 1.0,
+                }
+                for values in to_load[::step]
+            ]
+        )
+
+    def benchmark(self, size):
+        first = os.path.join(self.directory, f"first_{size}.xml")
+        later = os.path.join(self.directory, f"later_{size}.xml")
+        feed_generator.generate_feed(first, size)
+        feed_generator.generate_feed(later, size, generation=1)
+        phases = PhaseRecorder(self.env.cr)
+
+        loader = XMLProductLoader(self.cwa_product_obj)
+        with phases.measure("parse") as phase:
+            keys, to_load, _to_update, _to_delete = loader.parse_from_xml(first)
+            phase["rows"] = len(loader.new_unique_ids)
+        with phases.measure("load") as phase:
+            phase["rows"] = self.cwa_product_obj.bulk_load_records(
+                keys, to_load, "cwa.product"
+            )
+        self.create_supplierinfo(keys, to_load)
+
+        loader = XMLProductLoader(self.cwa_product_obj)
+        with phases.measure("parse_changes") as phase:
+            _keys, to_load, to_update, to_delete = loader.parse_from_xml(later)
+            phase["rows"] = len(loader.new_unique_ids)
+        with phases.measure("update") as phase:
+            phase["rows"] = self.cwa_product_obj.update_records(
+                to_update, "cwa.product"
+            )
+        with phases.measure("delete") as phase:
+            phase["rows"] = self.cwa_product_obj.delete_records(
+                to_delete, "cwa.product"
+            )
+        with phases.measure("compare_prices") as phase:
+            self.env["product.supplierinfo"].compare_prices()
+            self.env.flush_all()
+            phase["rows"] = self.env["product.supplierinfo"].search_count(
+                [("cwa", "=", True)]
+            )
+        return {"size": size, "phases": phases.phases}
+
+    def test_import_benchmark(self):
+        results = []
+        for size in map(int, BENCHMARK_SIZES.split(",")):
+            # every size starts from the same database
+            self.env.cr.execute("SAVEPOINT cwa_benchmark")
+            try:
+                results.append(self.benchmark(size))
+            finally:
+                self.env.cr.execute("ROLLBACK TO SAVEPOINT cwa_benchmark")
+                self.env.clear()
+        output = json.dumps(results, indent=2)
+        _logger.info("CWA import benchmark:\n%s", output)
+        if BENCHMARK_OUTPUT:
+            with open(BENCHMARK_OUTPUT, "w") as file:
+                file.write(output)
@@ -1,9 +1,21 @@
 import datetime
 import logging
 import os
+import tempfile
+from unittest.mock import patch
+
+from psycopg2 import errors
 
 from odoo.tests.common import TransactionCase
 
+from odoo.addons.product_import_cwa.models import cwa_import_run
+from odoo.addons.product_import_cwa.models.utils import (
+    LOAD_FIELDS,
+    CwaRecord,
+    PhaseRecorder,
+    XMLProductLoader,
+)
+
 
 class TestProductImportCwa(TransactionCase):
     def setUp(self):
@@ -84,13 +96,13 @@ class TestProductImportCwa(TransactionCase):
     def import_first_file(self, cwa_product_obj):
         path = os.path.dirname(os.path.realpath(__file__))
         file1 = os.path.join(path, "data/products_test.xml")
-        cwa_product_obj.with_context(new_cursor=False).import_xml_products(file1)
+        return cwa_product_obj.with_context(new_cursor=False).import_xml_products(file1)
 
-    def import_second_file(self, cwa_product_obj):
+    def import_second_file(self, cwa_product_obj, force=False):
         path = os.path.dirname(os.path.realpath(__file__))
         file2 = os.path.join(path, "data/products_test_modified.xml")
         count = cwa_product_obj.with_context(new_cursor=False).import_xml_products(
-            file2
+            file2, force=force
         )
         return count
 
@@ -121,12 +133,389 @@ class TestProductImportCwa(TransactionCase):
         )
         self.assertEqual(count, 65)
 
+    def test_product_import_cwa_skips_unchanged_feed(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        cwa_product_obj.search([("unique_id", "=", "1007-1001")]).unlink()
+
+        count = self.import_first_file(cwa_product_obj)
+        self.assertEqual(count, 0)
+        last_run = self.env["cwa.import.run"].search([], limit=1)
+        self.assertEqual(last_run.state, "skipped")
+        self.assertEqual(last_run.name, "products_test.xml")
+
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        count = cwa_product_obj.with_context(new_cursor=False).import_xml_products(
+            file1, force=True
+        )
+        self.assertEqual(count, 1)
+        last_run = self.env["cwa.import.run"].search([], limit=1)
+        self.assertEqual(last_run.state, "done")
+        self.assertTrue(last_run.forced)
+        self.assertEqual(last_run.file_size, os.path.getsize(file1))
+
+    def test_product_import_cwa_imports_as_chunked_jobs(self):
+        cwa_product_obj = self.env["cwa.product"].with_context(queue_job__no_delay=True)
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        run = cwa_product_obj.enqueue_xml_products_import(file1)
+
+        self.assertTrue(run.pipeline)
+        self.assertEqual(run.state, "done")
+        self.assertEqual(run.records_count, 65)
+        self.assertEqual(run.progress, 100)
+        self.assertTrue(run.chunk_ids)
+        self.assertEqual(set(run.chunk_ids.mapped("state")), {"done"})
+        self.assertFalse(any(run.chunk_ids.mapped("payload")))
+        self.assertEqual(cwa_product_obj.search_count([]), 65)
+
+        # Resuming a finished pipeline does not run its chunks again
+        run.action_resume()
+        self.assertEqual(run.records_count, 65)
+        self.assertEqual(cwa_product_obj.search_count([]), 65)
+
+    def test_product_import_cwa_chunked_jobs_honor_orm_load(self):
+        cwa_product_obj = self.env["cwa.product"].with_context(
+            queue_job__no_delay=True, cwa_orm_load=True
+        )
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        with patch.object(
+            type(cwa_product_obj),
+            "bulk_load_records",
+            side_effect=AssertionError("Bulk load used"),
+        ):
+            run = cwa_product_obj.enqueue_xml_products_import(file1)
+        self.assertEqual(run.state, "done")
+        self.assertEqual(cwa_product_obj.search_count([]), 65)
+
+    def test_product_import_cwa_failed_chunk_fails_the_run(self):
+        cwa_product_obj = self.env["cwa.product"].with_context(queue_job__no_delay=True)
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        bulk_load_records = type(cwa_product_obj).bulk_load_records
+        loads = []
+
+        def failing_bulk_load_records(self, keys, data, model):
+            loads.append(len(data))
+            if len(loads) == 2:
+                raise ValueError("Broken chunk")
+            return bulk_load_records(self, keys, data, model)
+
+        with patch.object(cwa_import_run, "PIPELINE_CHUNK_SIZE", 20), patch.object(
+            type(cwa_product_obj), "bulk_load_records", failing_bulk_load_records
+        ):
+            run = cwa_product_obj.enqueue_xml_products_import(file1)
+        self.assertEqual(run.state, "failed")
+        self.assertIn("Broken chunk", run.error)
+        self.assertEqual(
+            run.chunk_ids.mapped("state"), ["done", "pending", "pending", "pending"]
+        )
+        self.assertEqual(cwa_product_obj.search_count([]), 20)
+        # a failed run does not hold off the next imports
+        self.assertTrue(self.env["cwa.import.run"].acquire_import_lock())
+
+        run.action_resume()
+        self.assertEqual(run.state, "done")
+        self.assertFalse(run.error)
+        self.assertEqual(run.records_count, 65)
+        self.assertEqual(cwa_product_obj.search_count([]), 65)
+
+    def test_product_import_cwa_concurrency_error_retries_the_chunk(self):
+        cwa_product_obj = self.env["cwa.product"].with_context(queue_job__no_delay=True)
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        with patch.object(
+            type(cwa_product_obj),
+            "bulk_load_records",
+            side_effect=errors.SerializationFailure("Concurrent update"),
+        ), self.assertRaises(errors.SerializationFailure):
+            cwa_product_obj.enqueue_xml_products_import(file1)
+        # left for queue_job to retry, rather than failed
+        run = self.env["cwa.import.run"].search([], limit=1)
+        self.assertEqual(run.state, "running")
+        self.assertFalse(run.error)
+
+        run.action_resume()
+        self.assertEqual(run.state, "done")
+        self.assertEqual(cwa_product_obj.search_count([]), 65)
+
+    def test_product_import_cwa_fails_a_stale_pipeline(self):
+        run = self.env["cwa.import.run"].create(
+            {"name": "products_test.xml", "pipeline": True}
+        )
+        self.env.flush_all()
+        self.env.cr.execute(
+            "UPDATE cwa_import_run SET write_date = write_date - interval '1 day' "
+            "WHERE id = %s",
+            (run.id,),
+        )
+        run.invalidate_recordset(["write_date"])
+        count = self.import_first_file(self.env["cwa.product"])
+        self.assertEqual(count, 65)
+        self.assertEqual(run.state, "failed")
+
+    def test_product_import_cwa_skips_while_another_import_runs(self):
+        cwa_product_obj = self.env["cwa.product"]
+        runs = self.env["cwa.import.run"].search_count([])
+        with self.registry.cursor() as other_cr:
+            other_cr.execute(
+                "SELECT pg_advisory_xact_lock(%s)", (cwa_import_run.IMPORT_LOCK_KEY,)
+            )
+            count = self.import_first_file(cwa_product_obj)
+        self.assertEqual(count, 0)
+        self.assertFalse(cwa_product_obj.search([]))
+        self.assertEqual(self.env["cwa.import.run"].search_count([]), runs)
+
+        self.import_first_file(cwa_product_obj)
+        last_run = self.env["cwa.import.run"].search([], limit=1)
+        self.assertEqual(last_run.state, "done")
+        self.assertIn(self.env.user.name, last_run.lock_holder)
+
+    def test_product_import_cwa_skips_while_a_pipeline_runs(self):
+        self.env["cwa.import.run"].create(
+            {"name": "products_test.xml", "pipeline": True}
+        )
+        count = self.import_first_file(self.env["cwa.product"])
+        self.assertEqual(count, 0)
+        self.assertFalse(self.env["cwa.product"].search([]))
+
+    def test_product_import_cwa_records_phases_of_a_run(self):
+        self.import_first_file(self.env["cwa.product"])
+        last_run = self.env["cwa.import.run"].search([], limit=1)
+        phases = {phase.name: phase for phase in last_run.phase_ids}
+        self.assertEqual(set(phases), {"hash_load", "parse", "load", "compare_prices"})
+        self.assertEqual(phases["hash_load"].rows, 0)
+        self.assertEqual(phases["parse"].rows, 65)
+        self.assertEqual(phases["load"].rows, 65)
+        self.assertTrue(phases["load"].query_count)
+        self.assertTrue(all(phase.peak_rss > 0 for phase in last_run.phase_ids))
+
+    def test_product_import_cwa_phases_do_not_count_nested_phases(self):
+        phases = PhaseRecorder(self.env.cr)
+        with phases.measure("parse"):
+            with phases.measure("hash_load") as phase:
+                self.env.cr.execute("SELECT 1")
+                phase["rows"] = 1
+        hash_load, parse = phases.phases
+        self.assertEqual(hash_load["name"], "hash_load")
+        self.assertEqual(hash_load["query_count"], 1)
+        self.assertEqual(hash_load["rows"], 1)
+        self.assertEqual(parse["query_count"], 0)
+        self.assertLessEqual(parse["duration"], hash_load["duration"] + 1)
+
+    def test_product_import_cwa_phases_measure_their_own_peak_rss(self):
+        if not os.access("/proc/self/clear_refs", os.W_OK):
+            self.skipTest("The peak RSS of the process cannot be reset")
+        phases = PhaseRecorder(self.env.cr)
+        with phases.measure("parse"):
+            block = b"\1" * (128 * 1024 * 1024)
+            del block
+        with phases.measure("load"):
+            pass
+        parse, load = phases.phases
+        self.assertGreater(parse["peak_rss"] - load["peak_rss"], 64)
+
+    def test_product_import_cwa_dry_run_reports_without_writing(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        product = cwa_product_obj.search([("unique_id", "=", "1007-1001")])
+        runs = self.env["cwa.import.run"].search_count([])
+
+        path = os.path.dirname(os.path.realpath(__file__))
+        file2 = os.path.join(path, "data/products_test_modified.xml")
+        report = cwa_product_obj.dry_run_xml_products(file2)
+        self.assertEqual(report["products"], 65)
+        self.assertEqual(report["to_create"], 0)
+        self.assertEqual(report["to_update"], 1)
+        self.assertEqual(report["to_delete"], 0)
+        self.assertEqual(report["unchanged"], 64)
+        self.assertEqual(report["field_changes"]["consumentenprijs"], 1)
+        self.assertEqual(
+            [(mover["field"], mover["new"]) for mover in report["price_movers"]],
+            [("inkoopprijs", 2.3), ("consumentenprijs", 3.9)],
+        )
+
+        self.assertEqual(product.consumentenprijs, 3.7)
+        self.assertEqual(self.env["cwa.import.run"].search_count([]), runs)
+        self.assertFalse(self.env["cwa.import.product.change"].search([]))
+
+    def test_product_import_cwa_counts_unknown_tags(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(path, "data/products_test.xml"), "rb") as file:
+            content = file.read()
+        content = content.replace(
+            b"</product>", b"<nieuwekolom>1</nieuwekolom></product>"
+        )
+        with tempfile.NamedTemporaryFile(suffix=".xml") as feed:
+            feed.write(content)
+            feed.flush()
+            with self.assertLogs(
+                "odoo.addons.product_import_cwa.models.utils", level="WARNING"
+            ) as logs:
+                self.env["cwa.product"].import_xml_products(feed.name)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("nieuwekolom (65)", logs.output[0])
+        last_run = self.env["cwa.import.run"].search([], limit=1)
+        self.assertEqual(last_run.unknown_tags, {"nieuwekolom": 65})
+
+    def test_product_import_cwa_streams_products_from_file(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        products = list(XMLProductLoader.iter_products(file1))
+        self.assertEqual(len(products), 65)
+        # Earlier products are released while streaming
+        self.assertEqual(len(products[-1].getparent()), 1)
+
+    def test_product_import_cwa_converts_products_in_one_pass(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        loader = XMLProductLoader(self.env["cwa.product"])
+        product = next(XMLProductLoader.iter_products(file1))
+        id_values, values, present, feed_order = loader.convert_product(product)
+        self.assertEqual(loader.create_unique_id(id_values), "1007-1001")
+        record = CwaRecord(values, present)
+        self.assertIsNone(record["eancode"])
+        self.assertEqual(record["omschrijving"], "BOEKWEIT")
+        self.assertEqual(record["weegschaalartikel"], "false")
+        self.assertEqual(record["wichtartikel"], "true")
+        self.assertEqual(record["eenheid"], "KG")
+        self.assertEqual(record["proefdiervrij"], "0")
+        self.assertEqual(record["inkoopprijs"], "2.10")
+        # an empty packaging is not loaded at all
+        self.assertNotIn("verpakkingce", record)
+        # the fields in feed order, the record hash depends on it
+        feed_tags = [item.tag for item in product if item.tag != "verpakkingce"]
+        self.assertEqual([LOAD_FIELDS[index] for index in feed_order], feed_tags)
+
+    def test_product_import_cwa_parallel_parse_matches_serial_parse(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        path = os.path.dirname(os.path.realpath(__file__))
+        for name in ("products_test_modified.xml", "products_test_removed.xml"):
+            prod_file = os.path.join(path, "data", name)
+            serial = XMLProductLoader(cwa_product_obj).parse_from_xml(prod_file)
+            parallel = XMLProductLoader(cwa_product_obj).parse_from_xml_parallel(
+                prod_file, 2
+            )
+            self.assertEqual(serial[:3], parallel[:3])
+            self.assertEqual(sorted(serial[3]), sorted(parallel[3]))
+
+    def test_product_import_cwa_record_reads_like_a_dict(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        loader = XMLProductLoader(self.env["cwa.product"])
+        product = next(XMLProductLoader.iter_products(file1))
+        _unique_id, _hash, record = next(loader.parse_products([product]))
+        self.assertIsInstance(record, CwaRecord)
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertEqual(record["omschrijving"], record.get("omschrijving"))
+        self.assertEqual(len(record), len(dict(record)))
+        self.assertIn("unique_id", record)
+        self.assertNotIn("active", record)
+        self.assertIsNone(record.get("active"))
+        self.assertEqual(
+            list(record.values), [record.get(name) for name in LOAD_FIELDS]
+        )
+
+    def test_product_import_cwa_streams_existing_hashes(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        cwa_product_obj.search([], limit=1).active = False
+        products = cwa_product_obj.with_context(active_test=False).search([])
+
+        loader = XMLProductLoader(cwa_product_obj)
+        loader.fill_unique_ids_and_hash_dict()
+        self.assertEqual(set(loader.hash_dict), set(products.mapped("unique_id")))
+        for product in products:
+            self.assertEqual(loader.hash_dict[product.unique_id].hex(), product.hash)
+        self.assertEqual(len(loader.archived_unique_ids), 1)
+
+    def test_product_import_cwa_streams_hashes_after_failed_stream(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        with patch.object(
+            XMLProductLoader, "parse_stored_hash", side_effect=RuntimeError
+        ), self.assertRaises(RuntimeError):
+            XMLProductLoader(cwa_product_obj).fill_unique_ids_and_hash_dict()
+
+        # the cursor of the failed stream was closed
+        loader = XMLProductLoader(cwa_product_obj)
+        loader.fill_unique_ids_and_hash_dict()
+        self.assertEqual(len(loader.hash_dict), 65)
+
+    def test_product_import_cwa_tolerates_broken_stored_hashes(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        self.env.flush_all()
+        self.env.cr.execute(
+            "UPDATE cwa_product SET hash = 'not a hash' WHERE unique_id = '1007-1001'"
+        )
+        self.env.cr.execute(
+            "UPDATE cwa_product SET unique_id = NULL WHERE unique_id = '1007-1002'"
+        )
+        self.env.invalidate_all()
+
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        loader = XMLProductLoader(cwa_product_obj)
+        _keys, to_load, to_update, _to_delete = loader.parse_from_xml(file1)
+        self.assertIsNone(loader.hash_dict["1007-1001"])
+        self.assertNotIn(None, loader.hash_dict)
+        # a hash that cannot be compared counts as changed
+        self.assertEqual([values["unique_id"] for values in to_update], ["1007-1001"])
+        self.assertEqual(len(to_load), 1)
+
     def test_product_import_cwa_imports_is_correctly_loaded(self):
         cwa_product_obj = self.env["cwa.product"]
         self.import_first_file(cwa_product_obj)
         cwa_prod1 = cwa_product_obj.search([("omschrijving", "=", "BOEKWEIT")])
         self.assertEqual(len(cwa_prod1), 1)
 
+    def test_product_import_cwa_bulk_load_skips_invalid_rows(self):
+        cwa_product_obj = self.env["cwa.product"]
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        keys, to_load, _to_update, _to_delete = cwa_product_obj.parse_from_xml(file1)
+        date_index = keys.index("ingangsdatum")
+        to_load[0][date_index] = "not a date"
+        count = cwa_product_obj.bulk_load_records(keys, to_load, "cwa.product")
+        self.assertEqual(count, 64)
+        self.assertEqual(cwa_product_obj.search_count([]), 64)
+        loaded = cwa_product_obj.search([("omschrijving", "=", "GIERST")])
+        self.assertEqual(loaded.state, "new")
+        self.assertEqual(loaded.inkoopprijs, 2.45)
+
+    def test_product_import_cwa_bulk_load_after_failed_bulk_load(self):
+        cwa_product_obj = self.env["cwa.product"]
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        keys, to_load, _to_update, _to_delete = cwa_product_obj.parse_from_xml(file1)
+        # a load that fails halfway, leaving its staging table behind
+        with patch.object(
+            self.env.cr, "copy_expert", side_effect=RuntimeError("interrupted")
+        ), self.assertRaises(RuntimeError):
+            cwa_product_obj._copy_rows_into_table(keys, [], cwa_product_obj)
+        count = cwa_product_obj.bulk_load_records(keys, to_load, "cwa.product")
+        self.assertEqual(count, 65)
+
+    def test_product_import_cwa_load_isolates_failing_rows(self):
+        cwa_product_obj = self.env["cwa.product"].with_context(new_cursor=False)
+        path = os.path.dirname(os.path.realpath(__file__))
+        file1 = os.path.join(path, "data/products_test.xml")
+        keys, to_load, _to_update, _to_delete = cwa_product_obj.parse_from_xml(file1)
+        date_index = keys.index("ingangsdatum")
+        to_load[10][date_index] = "not a date"
+        count = cwa_product_obj.load_records(keys, to_load, "cwa.product")
+        self.assertEqual(count, 64)
+        self.assertEqual(cwa_product_obj.search_count([]), 64)
+        error = self.env["cwa.import.error"].search(
+            [("unique_id", "=", to_load[10][keys.index("unique_id")])]
+        )
+        self.assertEqual(len(error), 1)
+        self.assertIn("not a date", error.message)
+
     def test_product_import_cwa_load_modified_file(self):
         cwa_product_obj = self.env["cwa.product"]
         self.import_first_file(cwa_product_obj)
@@ -135,6 +524,102 @@ class TestProductImportCwa(TransactionCase):
         cwa_prod2 = cwa_product_obj.search([("omschrijving", "=", "BOEKWEIT")])
         self.assertTrue("EEKHOORNS" in cwa_prod2.ingredienten)
 
+    def test_product_import_cwa_updates_only_changed_fields(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        path = os.path.dirname(os.path.realpath(__file__))
+        file2 = os.path.join(path, "data/products_test_modified.xml")
+        _keys, _to_load, to_update, _to_delete = cwa_product_obj.parse_from_xml(file2)
+        self.assertEqual(len(to_update), 1)
+        self.assertEqual(
+            set(to_update[0]),
+            {
+                "unique_id",
+                "hash",
+                "field_hashes",
+                "inkoopprijs",
+                "consumentenprijs",
+                "ingredienten",
+            },
+        )
+
+    def test_product_import_cwa_backfills_field_hashes(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        self.env.flush_all()
+        # imported before the per-field digests existed
+        self.env.cr.execute("UPDATE cwa_product SET field_hashes = NULL")
+        self.env.invalidate_all()
+
+        self.assertEqual(cwa_product_obj._backfill_field_hashes(), 65)
+        path = os.path.dirname(os.path.realpath(__file__))
+        file2 = os.path.join(path, "data/products_test_modified.xml")
+        _keys, _to_load, to_update, _to_delete = cwa_product_obj.parse_from_xml(file2)
+        self.assertEqual(
+            set(to_update[0]),
+            {
+                "unique_id",
+                "hash",
+                "field_hashes",
+                "inkoopprijs",
+                "consumentenprijs",
+                "ingredienten",
+            },
+        )
+        self.assertEqual(cwa_product_obj._backfill_field_hashes(), 0)
+
+    def test_product_import_cwa_reordered_tags_only_update_the_hash(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        product = cwa_product_obj.search([("unique_id", "=", "1007-1001")])
+        old_hash = product.hash
+        path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(path, "data/products_test.xml"), "rb") as file:
+            content = file.read()
+        # the tags of the first product come in another order
+        content = content.replace(
+            b"<sve>10</sve>\n  <status>Actief</status>",
+            b"<status>Actief</status>\n  <sve>10</sve>",
+            1,
+        )
+        write = type(cwa_product_obj).write
+        writes = []
+
+        def recording_write(records, vals):
+            writes.append(vals)
+            return write(records, vals)
+
+        with tempfile.NamedTemporaryFile(suffix=".xml") as feed:
+            feed.write(content)
+            feed.flush()
+            _keys, _to_load, to_update, _to_delete = cwa_product_obj.parse_from_xml(
+                feed.name
+            )
+            self.assertEqual(len(to_update), 1)
+            self.assertEqual(set(to_update[0]), {"unique_id", "hash", "field_hashes"})
+            with patch.object(type(cwa_product_obj), "write", recording_write):
+                count = cwa_product_obj.import_xml_products(feed.name)
+        self.assertEqual(count, 1)
+        self.assertFalse(writes)
+        product.invalidate_recordset()
+        self.assertNotEqual(product.hash, old_hash)
+
+    def test_product_import_cwa_update_records_groups_identical_values(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        records = [
+            {"unique_id": "1007-1001", "hash": "hash-1", "status": "NON ACTIEF"},
+            {"unique_id": "1007-1002", "hash": "hash-2", "status": "NON ACTIEF"},
+            {"unique_id": "does-not-exist", "hash": "hash-3", "status": "ACTIEF"},
+        ]
+        count = cwa_product_obj.update_records(records, "cwa.product")
+        self.assertEqual(count, 2)
+        updated = cwa_product_obj.search(
+            [("unique_id", "in", ["1007-1001", "1007-1002"])], order="unique_id"
+        )
+        self.assertEqual(updated.mapped("status"), ["NON ACTIEF", "NON ACTIEF"])
+        self.assertEqual(updated.mapped("hash"), ["hash-1", "hash-2"])
+
     def test_product_import_cwa_translations(self):
         cwa_product_obj = self.env["cwa.product"]
         self.import_first_file(cwa_product_obj)
@@ -232,6 +717,146 @@ class TestProductImportCwa(TransactionCase):
         self.assertEqual(supp_info1.eenheid, "KG")
         self.assertEqual(supp_info1.herkomst, "CN")
 
+    def test_product_import_cwa_compare_prices_flags_new_prices(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        cwa_prod = cwa_product_obj.search([("omschrijving", "=", "BOEKWEIT")])
+        self.add_translations_for_brand_uom_cblcode_and_tax(cwa_prod)
+        self.create_origin()
+        cwa_prod.to_product()
+        supp_info = self.env["product.supplierinfo"].search(
+            [("unique_id", "=", "1007-1001")]
+        )
+        other_prod = cwa_product_obj.search([("unique_id", "=", "1007-1002")])
+        other_prod.state = "imported"
+
+        cwa_prod.write({"inkoopprijs": 2.5, "consumentenprijs": 4.25})
+        supp_info.compare_prices()
+        self.assertTrue(supp_info.has_new_price)
+        self.assertEqual(supp_info.price, 2.5)
+        self.assertEqual(supp_info.consumentenprijs, 4.25)
+        self.assertTrue(supp_info.product_tmpl_id.has_new_price)
+        self.assertEqual(cwa_prod.state, "imported")
+        # imported products without a supplier info are new again
+        self.assertEqual(other_prod.state, "new")
+
+        supp_info.update_price()
+        supp_info.compare_prices()
+        self.assertFalse(supp_info.has_new_price)
+        self.assertFalse(supp_info.product_tmpl_id.has_new_price)
+
+    def test_product_import_cwa_compare_prices_of_touched_products(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        cwa_prod = cwa_product_obj.search([("omschrijving", "=", "BOEKWEIT")])
+        self.add_translations_for_brand_uom_cblcode_and_tax(cwa_prod)
+        self.create_origin()
+        cwa_prod.to_product()
+        supp_info = self.env["product.supplierinfo"].search(
+            [("unique_id", "=", "1007-1001")]
+        )
+        cwa_prod.write({"inkoopprijs": 2.5})
+
+        supp_info.compare_prices(["1007-1002"])
+        self.assertFalse(supp_info.has_new_price)
+        supp_info.compare_prices(["1007-1001"])
+        self.assertTrue(supp_info.has_new_price)
+
+        # the full reconcile compares the whole catalog
+        cwa_prod.write({"inkoopprijs": 2.75})
+        cwa_product_obj.compare_all_supplier_prices()
+        self.assertEqual(supp_info.price, 2.75)
+
+    def test_product_import_cwa_compare_prices_after_failed_comparison(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        cwa_prod = cwa_product_obj.search([("omschrijving", "=", "BOEKWEIT")])
+        self.add_translations_for_brand_uom_cblcode_and_tax(cwa_prod)
+        self.create_origin()
+        cwa_prod.to_product()
+        supp_info = self.env["product.supplierinfo"].search(
+            [("unique_id", "=", "1007-1001")]
+        )
+        # a comparison that failed halfway left its table behind
+        self.env.cr.execute("CREATE TEMP TABLE cwa_compare_prices (id integer)")
+        cwa_prod.write({"inkoopprijs": 2.5})
+        supp_info.compare_prices()
+        self.assertTrue(supp_info.has_new_price)
+
+    def test_product_import_cwa_write_propagates_each_product_values(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        cwa_prods = cwa_product_obj.search(
+            [("unique_id", "in", ["1007-1001", "1007-1002"])]
+        )
+        self.add_translations_for_brand_uom_cblcode_and_tax(cwa_prods)
+        self.create_origin()
+        for cwa_prod in cwa_prods:
+            cwa_prod.to_product()
+
+        cwa_prods.write({"inkoopprijs": 9.0})
+        for cwa_prod in cwa_prods:
+            supp_info = self.env["product.supplierinfo"].search(
+                [("unique_id", "=", cwa_prod.unique_id)]
+            )
+            self.assertEqual(supp_info.omschrijving, cwa_prod.omschrijving)
+            self.assertEqual(supp_info.inkoopprijs, 9.0)
+            changes = self.env["cwa.import.product.change"].search(
+                [("source_cwa_product_id", "=", cwa_prod.id)]
+            )
+            self.assertEqual(len(changes), 1)
+            self.assertEqual(changes.value_changes["inkoopprijs"]["new"], 9.0)
+
+        # writing unrelated fields leaves the supplier infos alone
+        cwa_prods.write({"state": "new"})
+        self.assertEqual(
+            self.env["cwa.import.product.change"].search_count(
+                [("source_cwa_product_id", "in", cwa_prods.ids)]
+            ),
+            2,
+        )
+
+    def test_product_import_cwa_write_skips_unchanged_supplier_info_values(self):
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        cwa_prods = cwa_product_obj.search(
+            [("unique_id", "in", ["1007-1001", "1007-1002"])]
+        )
+        self.add_translations_for_brand_uom_cblcode_and_tax(cwa_prods)
+        self.create_origin()
+        for cwa_prod in cwa_prods:
+            cwa_prod.to_product()
+        # Char fields of the product copied to Integer fields of the
+        # supplier info
+        cwa_prods.write({"bewaartemperatuur": "7", "aantaldagenhoudbaar": "14"})
+        changes = self.env["cwa.import.product.change"].search(
+            [("source_cwa_product_id", "in", cwa_prods.ids)]
+        )
+        supplierinfo_model = type(self.env["product.supplierinfo"])
+        write = supplierinfo_model.write
+        writes = []
+
+        def recording_write(records, vals):
+            writes.append((records, vals))
+            return write(records, vals)
+
+        with patch.object(supplierinfo_model, "write", recording_write):
+            cwa_prods.write({"inkoopprijs": 9.0})
+            self.assertEqual(len(writes), 1)
+            self.assertEqual(len(writes[0][0]), 2)
+            self.assertEqual(writes[0][1], {"inkoopprijs": 9.0})
+
+            writes.clear()
+            cwa_prods.write({"inkoopprijs": 9.0})
+            self.assertFalse(writes)
+        # the change records are updated in place
+        self.assertEqual(
+            self.env["cwa.import.product.change"].search(
+                [("source_cwa_product_id", "in", cwa_prods.ids)]
+            ),
+            changes,
+        )
+
     def test_product_import_cwa_handle_multiple_suppliers(self):
         cwa_product_obj = self.env["cwa.product"]
         self.import_first_file(cwa_product_obj)
@@ -255,7 +880,8 @@ class TestProductImportCwa(TransactionCase):
 
         self.import_second_file(cwa_product_obj)
 
-        count = self.import_second_file(cwa_product_obj)
+        # forced, so the records are compared rather than the feed skipped
+        count = self.import_second_file(cwa_product_obj, force=True)
         self.assertEqual(count, 0)
         suppliers_after_import = supplierinfo_obj.search_count([])
         self.assertEqual(suppliers_before_import, suppliers_after_import)
@@ -271,6 +897,53 @@ class TestProductImportCwa(TransactionCase):
         self.assertEqual(count, 1)
         self.assertEqual(cwa_product_obj.search_count([]), 64)
 
+    def test_product_import_cwa_removal_archives_and_revives(self):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cwa_archive_removed_products", True
+        )
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        path = os.path.dirname(os.path.realpath(__file__))
+        file3 = os.path.join(path, "data/products_test_removed.xml")
+        count = cwa_product_obj.with_context(new_cursor=False).import_xml_products(
+            file3
+        )
+        self.assertEqual(count, 1)
+        self.assertEqual(cwa_product_obj.search_count([]), 64)
+        all_products = cwa_product_obj.with_context(active_test=False)
+        self.assertEqual(all_products.search_count([]), 65)
+
+        # Archived products are not archived again
+        count = cwa_product_obj.with_context(new_cursor=False).import_xml_products(
+            file3, force=True
+        )
+        self.assertEqual(count, 0)
+        self.assertEqual(self.env["cwa.import.run"].search([], limit=1).state, "done")
+
+        count = self.import_first_file(cwa_product_obj)
+        self.assertEqual(count, 1)
+        self.assertEqual(cwa_product_obj.search_count([]), 65)
+        self.assertEqual(all_products.search_count([]), 65)
+
+    def test_product_import_cwa_removal_unlinks_archived_when_not_archiving(self):
+        config_parameter = self.env["ir.config_parameter"].sudo()
+        config_parameter.set_param("cwa_archive_removed_products", True)
+        cwa_product_obj = self.env["cwa.product"]
+        self.import_first_file(cwa_product_obj)
+        path = os.path.dirname(os.path.realpath(__file__))
+        file3 = os.path.join(path, "data/products_test_removed.xml")
+        cwa_product_obj.with_context(new_cursor=False).import_xml_products(file3)
+        all_products = cwa_product_obj.with_context(active_test=False)
+        self.assertEqual(all_products.search_count([]), 65)
+
+        # once archiving is switched off the archived product is unlinked
+        config_parameter.set_param("cwa_archive_removed_products", False)
+        count = cwa_product_obj.with_context(new_cursor=False).import_xml_products(
+            file3, force=True
+        )
+        self.assertEqual(count, 1)
+        self.assertEqual(all_products.search_count([]), 64)
+
     def test_product_import_cwa_recovers_from_invalid_characters_in_xml(self):
         cwa_product_obj = self.env["cwa.product"]
 
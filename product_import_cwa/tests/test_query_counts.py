@@ -0,0 +1,152 @@
+from odoo.tests.common import TransactionCase
+
+SUPPLIER_NUMBERS = ("1001", "1002", "1007")
+
+
+class TestQueryCounts(TransactionCase):
+    """
+    The hot paths of the import must not run queries per record: the number
+    of queries they run is the same for 10 and for 100 records.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.cwa_product_obj = self.env["cwa.product"]
+        self.product_tmpl = self.env["product.template"].create(
+            {"name": "Query count product"}
+        )
+        self.partner = self.env["res.partner"].create({"name": "Query count vendor"})
+        self.serial = 0
+
+    def create_cwa_products(self, count):
+        values = []
+        for _number in range(count):
+            self.serial += 1
+            supplier_number = SUPPLIER_NUMBERS[self.serial % len(SUPPLIER_NUMBERS)]
+            values.append(
+                {
+                    "unique_id": f"{supplier_number}-{90000 + self.serial}",
+                    "leveranciernummer": supplier_number,
+                    "bestelnummer": str(90000 + self.serial),
+                    "omschrijving": f"Product {self.serial}",
+                    "inkoopprijs": 1.0,
+                    "consumentenprijs": 2.0,
+                    "hash": f"{self.serial:032x}",
+                }
+            )
+        return self.cwa_product_obj.create(values)
+
+    def create_supplierinfo(self, cwa_products):
+        return self.env["product.supplierinfo"].create(
+            [
+                {
+                    "partner_id": self.partner.id,
+                    "product_tmpl_id": self.product_tmpl.id,
+                    "cwa": True,
+                    "unique_id": cwa_product.unique_id,
+                    "price": cwa_product.inkoopprijs,
+                }
+                for cwa_product in cwa_products
+            ]
+        )
+
+    def count_queries(self, function):
+        self.env.flush_all()
+        self.env.invalidate_all()
+        start = self.env.cr.sql_log_count
+        function()
+        self.env.flush_all()
+        return self.env.cr.sql_log_count - start
+
+    def assertQueryCountIndependentOfSize(self, prepare):
+        """
+        prepare(count) sets up count records and returns the function of
+        which the queries are counted.
+        """
+        # a first round fills the caches of the registry
+        self.count_queries(prepare(3))
+        count_10 = self.count_queries(prepare(10))
+        count_100 = self.count_queries(prepare(100))
+        self.assertEqual(
+            count_10,
+            count_100,
+            f"{count_10} queries for 10 records, {count_100} for 100 records",
+        )
+
+    def test_compute_vendor_id_query_count(self):
+        def prepare(count):
+            cwa_products = self.create_cwa_products(count)
+            return lambda: cwa_products.mapped("vendor_id")
+
+        self.assertQueryCountIndependentOfSize(prepare)
+
+    def test_write_query_count(self):
+        def prepare(count):
+            cwa_products = self.create_cwa_products(count)
+            return lambda: cwa_products.write({"inkoopprijs": 1.5})
+
+        self.assertQueryCountIndependentOfSize(prepare)
+
+    def test_write_propagation_query_count(self):
+        def prepare(count):
+            cwa_products = self.create_cwa_products(count)
+            self.create_supplierinfo(cwa_products)
+            self.env["product.template"].create(
+                [
+                    {
+                        "name": cwa_product.omschrijving,
+                        "unique_id": cwa_product.unique_id,
+                    }
+                    for cwa_product in cwa_products
+                ]
+            )
+            # a first write copies the products to their supplier infos
+            cwa_products.write({"inkoopprijs": 1.25})
+            return lambda: cwa_products.write({"inkoopprijs": 1.5})
+
+        self.assertQueryCountIndependentOfSize(prepare)
+
+    def test_update_records_query_count(self):
+        def prepare(count):
+            records = [
+                {
+                    "unique_id": cwa_product.unique_id,
+                    "hash": f"{cwa_product.id:032x}",
+                    "status": "Non actief",
+                }
+                for cwa_product in self.create_cwa_products(count)
+            ]
+            return lambda: self.cwa_product_obj.update_records(records, "cwa.product")
+
+        self.assertQueryCountIndependentOfSize(prepare)
+
+    def test_delete_records_query_count(self):
+        def prepare(count):
+            unique_ids = self.create_cwa_products(count).mapped("unique_id")
+            return lambda: self.cwa_product_obj.delete_records(
+                unique_ids, "cwa.product"
+            )
+
+        self.assertQueryCountIndependentOfSize(prepare)
+
+    def test_delete_records_archiving_query_count(self):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cwa_archive_removed_products", True
+        )
+        self.test_delete_records_query_count()
+
+    def test_supplierinfo_unlink_query_count(self):
+        def prepare(count):
+            supplierinfo = self.create_supplierinfo(self.create_cwa_products(count))
+            return supplierinfo.unlink
+
+        self.assertQueryCountIndependentOfSize(prepare)
+
+    def test_compare_prices_query_count(self):
+        def prepare(count):
+            cwa_products = self.create_cwa_products(count)
+            self.create_supplierinfo(cwa_products)
+            cwa_products.write({"inkoopprijs": 1.25})
+            return self.env["product.supplierinfo"].compare_prices
+
+        self.assertQueryCountIndependentOfSize(prepare)
@@ -1,4 +1,5 @@
 from . import cwa_import_wizard
+from . import cwa_import_feed_wizard
 from . import cwa_brand_translation_wizard
 from . import cwa_uom_translation_wizard
 from . import cwa_cblcode_translation_wizard
@@ -0,0 +1,32 @@
+import json
+
+from odoo import fields, models
+
+
+class CwaImportFeedWizard(models.TransientModel):
+    _name = "cwa.import.feed.wizard"
+    _description = "Import the CWA feed"
+
+    force = fields.Boolean(
+        help="Import the feed even when it is identical to the last imported one."
+    )
+    report = fields.Text("Dry run report", readonly=True)
+
+    def action_import(self):
+        self.ensure_one()
+        self.env["cwa.product"].import_xml_products(prod_file=False, force=self.force)
+        return self.env["ir.actions.actions"]._for_xml_id(
+            "product_import_cwa.action_cwa_import_run"
+        )
+
+    def action_dry_run(self):
+        self.ensure_one()
+        report = self.env["cwa.product"].dry_run_xml_products(prod_file=False)
+        self.report = json.dumps(report, indent=2) if report else "XML file not found!"
+        return {
+            "type": "ir.actions.act_window",
+            "res_model": self._name,
+            "res_id": self.id,
+            "view_mode": "form",
+            "target": "new",
+        }